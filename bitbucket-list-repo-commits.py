@@ -1,45 +1,313 @@
 #!/usr/bin/env python3
-# bitbucket-list-repo-commits.py - Return a CSV of Bitbucket repositories
+# bitbucket-list-repo-commits.py - Return a CSV of the commits of Bitbucket repositories, or store them in SQLite
 
-import sys, requests
-from requests.auth import HTTPBasicAuth
+import io
+import os
+import sys
+import csv
+import json
+import time
+import getopt
+import netrc
+import sqlite3
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+API_HOST = "api.bitbucket.org"
+# The largest page the commits endpoint returns
+PAGELEN = 100
+# Buffer size for standard output when it is not a terminal
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+OUTPUT_FORMATS = [ "csv", "jsonl" ]
 
-team = sys.argv[1]
-repo = sys.argv[2]
+COLUMNS = [ "hash", "author", "date", "summary", "parents" ]
+# Only these fields are asked for (with fields=), so responses carry nothing else
+FIELDS = [ "hash", "author.raw", "date", "message", "parents.hash" ]
 
-##Login
-username = None
-password = None
 
-full_repo_list = []
+def new_session(pool_size=10, retries=5, backoff=1.0):
+    # One session for every request, so connections are kept alive and reused.
+    # Requests that get a 429 or 5xx are retried with exponential backoff,
+    # waiting for as long as a Retry-After header asks for.
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    # Look the credentials up in ~/.netrc once, instead of on every request
+    try:
+        auth = netrc.netrc().authenticators(API_HOST)
+    except (IOError, netrc.NetrcParseError):
+        auth = None
+    if auth is not None:
+        session.auth = (auth[0], auth[2])
+    return session
 
-# Request 100 repositories per page (and only their slugs), and the next page URL
-#next_page_url = 'https://api.bitbucket.org/2.0/repositories/%s?pagelen=10&fields=next,values.links.clone.href,values.slug' % team
-next_page_url = 'https://api.bitbucket.org/2.0/repositories/%s/%s/commits' % (team, repo)
 
-# Keep fetching pages while there's a page to fetch
-while next_page_url is not None:
-  if username != None and password != None:
-    response = requests.get(next_page_url, auth=HTTPBasicAuth(username, password))
-  else:
-    response = requests.get(next_page_url)
-    
-  page_json = response.json()
+def ordered_map(func, items, jobs=1):
+    # Apply func to items on a pool of 'jobs' threads, yielding (item, result) in
+    # the order of items. Only a few times 'jobs' items are in flight at once, so
+    # results stream out while 'items' is still being read.
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= jobs * 4:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
 
-  print(response.text)
-  break
 
-  # Parse repositories from the JSON
-  for repo in page_json['values']:
-    reponame=repo['slug']
-    repohttp=repo['links']['clone'][0]['href']
-    repogit=repo['links']['clone'][1]['href']
+def load_list(arg):
+    # arg can be a "file:///path/to/a/file", or "-" to read from stdin; returns a list
+    if arg.startswith("file://"):
+        with open(arg[7:]) as f:
+            return [line.strip() for line in f if line.strip()]
+    return [line.strip() for line in sys.stdin if line.strip()]
 
-    print( reponame + "," + repohttp + "," + repogit )
-    full_repo_list.append(repo['slug'])
-    
 
-  # Get the next page URL, if present
-  # It will include same query parameters, so no need to append them again
-  next_page_url = page_json.get('next', None)
+def team_repos(session, team):
+    # Yields the slugs of TEAM's repositories as their pages arrive
+    next_page_url = "https://api.bitbucket.org/2.0/repositories/%s?pagelen=%i&fields=next,values.slug" % (team, PAGELEN)
+    while next_page_url is not None:
+        response = session.get(next_page_url)
+        response.raise_for_status()
+        page_json = response.json()
+        for repo in page_json.get('values', []):
+            yield repo['slug']
+        next_page_url = page_json.get('next', None)
+
+
+def commits_url(team, repo):
+    return "https://api.bitbucket.org/2.0/repositories/%s/%s/commits?pagelen=%i&fields=%s" % (
+        team, repo, PAGELEN, ",".join(["next"] + ["values.%s" % f for f in FIELDS]))
+
+
+def commits(session, team, repo, stop_hash=None):
+    # Yields the commits of TEAM/REPO newest first, following 'next' links through
+    # the whole history, or up to (not including) the commit 'stop_hash'.
+    # Raises requests.RequestException if a page cannot be fetched.
+    next_page_url = commits_url(team, repo)
+    while next_page_url is not None:
+        response = session.get(next_page_url)
+        response.raise_for_status()
+        page_json = response.json()
+        for commit in page_json.get('values', []):
+            if stop_hash is not None and commit['hash'].startswith(stop_hash):
+                return
+            yield commit
+        next_page_url = page_json.get('next', None)
+
+
+def commit_row(commit):
+    message = commit.get('message') or ""
+    return [
+        commit['hash'],
+        (commit.get('author') or {}).get('raw', None),
+        commit.get('date', None),
+        message.splitlines()[0] if message else "",
+        " ".join(parent['hash'] for parent in commit.get('parents', [])),
+    ]
+
+
+def repo_commits(session, team, repo, stop_hash=None):
+    # All new commits of one repository as rows, or the error that stopped the listing
+    try:
+        return [commit_row(commit) for commit in commits(session, team, repo, stop_hash)]
+    except (requests.RequestException, ValueError) as e:
+        return e
+
+
+class CommitStore:
+    # SQLite store of commits, indexed by repository and date, with the newest
+    # commit stored of every repository so later runs only fetch newer commits
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS commits (repo TEXT, hash TEXT, author TEXT, "
+                        "date TEXT, summary TEXT, parents TEXT, PRIMARY KEY (repo, hash))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS commits_repo_date ON commits (repo, date)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cursors (repo TEXT PRIMARY KEY, hash TEXT, synced TEXT)")
+
+    def cursor(self, repo):
+        row = self.db.execute("SELECT hash FROM cursors WHERE repo = ?", (repo,)).fetchone()
+        return row[0] if row else None
+
+    def upsert(self, repo, rows):
+        # Stores the rows of one repository and moves its cursor to the newest, in one transaction
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO commits VALUES (?, ?, ?, ?, ?, ?)",
+                                [[repo] + row for row in rows])
+            if rows:
+                self.db.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?, ?)",
+                                (repo, rows[0][0], time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())))
+
+    def close(self):
+        self.db.close()
+
+
+def export_repos(session, team, repos, out, store=None, jobs=1):
+    # Fetches the commits of many repositories on 'jobs' threads, writing them in the
+    # order of 'repos' to 'out' (with a repo column), or into 'store'. Returns the
+    # number of repositories that failed.
+    stops = {}
+    if store is not None:
+        # read in this thread, since the store's connection must stay in it
+        repos = list(repos)
+        stops = dict((repo, store.cursor("%s/%s" % (team, repo))) for repo in repos)
+    fetch = lambda repo: repo_commits(session, team, repo, stops.get(repo, None))
+    failed = 0
+    for repo, rows in ordered_map(fetch, repos, jobs):
+        if isinstance(rows, Exception):
+            print("Error getting commits of '%s/%s': '%s'" % (team, repo, rows), file=sys.stderr)
+            failed += 1
+        elif store is not None:
+            store.upsert("%s/%s" % (team, repo), rows)
+            print("%s/%s: %i new commits" % (team, repo, len(rows)), file=sys.stderr)
+        else:
+            for row in rows:
+                out.writerow([repo] + row)
+    return failed
+
+
+def setup_output():
+    # Standard output is flushed line by line on a terminal, and buffered into
+    # large writes when it is a file or a pipe
+    tty = sys.stdout.isatty()
+    sys.stdout.flush()
+    sys.stdout = io.TextIOWrapper(open(sys.stdout.fileno(), 'wb', OUTPUT_BUFFER_SIZE, closefd=False),
+                                  encoding=sys.stdout.encoding, line_buffering=tty)
+
+
+class RowWriter:
+    # Writes rows as CSV with a header line, or as JSON Lines: one object per row,
+    # keyed by column name
+    def __init__(self, fp, columns, output_format="csv"):
+        self.fp, self.columns, self.output_format = fp, columns, output_format
+        if output_format == "csv":
+            self.csvw = csv.writer(fp, quoting=csv.QUOTE_NONNUMERIC)
+            self.csvw.writerow(columns)
+
+    def writerow(self, row):
+        if self.output_format == "csv":
+            self.csvw.writerow(row)
+        else:
+            self.fp.write(json.dumps(dict(zip(self.columns, row))) + "\n")
+
+
+def read_cursor(path):
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_cursor(path, commit_hash):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(commit_hash + "\n")
+    os.replace(tmp, path)
+
+
+def usage():
+    print("""Usage: %s [-o FORMAT] [-s HASH] [-c CURSOR_FILE] TEAM REPO
+       %s [-o FORMAT] [-j JOBS] [-d DATABASE] TEAM file:///path/to/a/file|-
+       %s [-o FORMAT] [-j JOBS] [-d DATABASE] -A TEAM
+
+Prints the commits of TEAM/REPO, newest first, with their hash, author, date,
+the first line of the message, and parent hashes.
+
+Given a "file:///path/to/a/file" or "-" (standard input) listing one repository
+per line instead of REPO, or -A for every repository of TEAM, prints the commits
+of all of them with a repo column, fetching JOBS repositories at the same time.
+
+Options:
+  -o FORMAT         "csv" (default) or "jsonl" (JSON Lines, one object per commit)
+  -s HASH           Stop at commit HASH, printing only the commits after it
+  -c CURSOR_FILE    Stop at the commit recorded in CURSOR_FILE, and record the newest
+                    commit in it once every new commit is printed, so the next run
+                    only prints commits made since
+  -j JOBS           Number of repositories to fetch at the same time (default: 1)
+  -A                Export every repository of TEAM, listing them as they are fetched
+  -d DATABASE       Store the commits in the SQLite file DATABASE instead of printing
+                    them. Only commits newer than the ones stored are fetched.
+""" % (sys.argv[0], sys.argv[0], sys.argv[0]))
+    exit(1)
+
+
+def main():
+    try:
+        opts, argv = getopt.getopt(sys.argv[1:], "o:s:c:j:d:Ah")
+    except getopt.GetoptError as e:
+        print("Error: %s" % e, file=sys.stderr)
+        usage()
+    output_format, stop_hash, cursor_file, jobs, database, all_repos = "csv", None, None, 1, None, False
+    for o, a in opts:
+        if   o == '-o':  output_format = a
+        elif o == '-s':  stop_hash = a
+        elif o == '-c':  cursor_file = a
+        elif o == '-j':  jobs = int(a)
+        elif o == '-d':  database = a
+        elif o == '-A':  all_repos = True
+        elif o == '-h':  usage()
+    if len(argv) != (1 if all_repos else 2) or output_format not in OUTPUT_FORMATS:
+        usage()
+    team = argv[0]
+    many = all_repos or argv[1] == "-" or argv[1].startswith("file://")
+
+    setup_output()
+    session = new_session(pool_size=max(10, jobs))
+
+    if many or database is not None:
+        if stop_hash is not None or cursor_file is not None:
+            print("Error: -s and -c only work with a single REPO and no -d", file=sys.stderr)
+            exit(1)
+        if all_repos:
+            repos = team_repos(session, team)
+        elif many:
+            repos = load_list(argv[1])
+        else:
+            repos = [argv[1]]
+        store = CommitStore(database) if database is not None else None
+        out = RowWriter(sys.stdout, ["repo"] + COLUMNS, output_format) if store is None else None
+        try:
+            failed = export_repos(session, team, repos, out, store, jobs)
+        except (requests.RequestException, ValueError) as e:
+            print("Error listing the repositories of '%s': '%s'" % (team, e), file=sys.stderr)
+            exit(1)
+        finally:
+            if store is not None:
+                store.close()
+        if failed:
+            exit(1)
+        return
+
+    repo = argv[1]
+    if cursor_file is not None and stop_hash is None:
+        stop_hash = read_cursor(cursor_file)
+    out = RowWriter(sys.stdout, COLUMNS, output_format)
+    newest = None
+    try:
+        for commit in commits(session, team, repo, stop_hash):
+            if newest is None:
+                newest = commit['hash']
+            out.writerow(commit_row(commit))
+    except (requests.RequestException, ValueError) as e:
+        print("Error getting commits of '%s/%s': '%s'" % (team, repo, e), file=sys.stderr)
+        exit(1)
+    if cursor_file is not None and newest is not None:
+        write_cursor(cursor_file, newest)
+
+
+if __name__ == "__main__":
+    main()
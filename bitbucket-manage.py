@@ -5,60 +5,344 @@ import io
 import os
 import sys
 import csv
+import json
+import time
+import hashlib
+import tempfile
+import threading
 import netrc
 import requests
-from datetime import datetime
-import dateutil
-from dateutil import parser, tz
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timezone
 import getopt
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-os.environ['PYTHONUNBUFFERED'] = '1'
-sys.stdout = io.TextIOWrapper(open(sys.stdout.fileno(), 'wb', 0), write_through=True)
+# Buffer size for standard output when it is not a terminal
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+OUTPUT_FORMATS = [ "csv", "jsonl" ]
+
+API_HOST = "api.bitbucket.org"
+# The largest page the list endpoints return
+PAGELEN = 100
+
+# CSV columns of each listing, and the field of the API object each one comes from.
+# Only these fields are asked for (with fields=), so responses carry nothing else.
+REPO_COLUMNS = [
+    ("slug", "slug"), ("name", "name"), ("created_on", "created_on"),
+    ("updated_on", "updated_on"), ("has_issues", "has_issues"), ("has_wiki", "has_wiki")
+]
+DEPLOY_KEY_COLUMNS = [
+    ("repo", "repository.name"), ("id", "id"), ("type", "type"), ("created_on", "created_on"),
+    ("last_used", "last_used"), ("public_key", "key"), ("comment", "comment"), ("label", "label")
+]
+
+def get_field(obj, path):
+    # Gets a dotted field like "repository.name" out of an API object
+    for part in path.split("."):
+        if obj is None: return None
+        obj = obj.get(part)
+    if isinstance(obj, str):
+        return obj.rstrip()
+    return obj
+
+def list_url(url, fields, query=None):
+    # A list endpoint URL asking for the largest pages, with only 'fields' of each value,
+    # and only the values matching a 'query' filter like 'updated_on>=2020-01-01' if given
+    url = "%s?pagelen=%i&fields=%s" % (url, PAGELEN, ",".join(["next", "size", "page", "pagelen"] + ["values.%s" % f for f in fields]))
+    if query is not None:
+        url += "&q=%s" % quote(query)
+    return url
+
+def other_page_urls(page_json):
+    # The URLs of the pages after page_json, made by changing the page number of its
+    # 'next' link. None if the list is not paged by number or its size is unknown.
+    next_url = page_json.get('next', None)
+    if next_url is None or 'size' not in page_json or not page_json.get('pagelen'):
+        return(None)
+    parts = urlsplit(next_url)
+    query = parse_qsl(parts.query)
+    if 'page' not in dict(query):
+        return(None)
+    pages = (page_json['size'] + page_json['pagelen'] - 1) // page_json['pagelen']
+    urls = []
+    for page in range(page_json.get('page', 1) + 1, pages + 1):
+        page_query = [(k, str(page) if k == 'page' else v) for k, v in query]
+        urls.append(urlunsplit(parts._replace(query=urlencode(page_query))))
+    return(urls)
+
+def ordered_map(func, items, jobs=1):
+    # Apply func to items on a pool of 'jobs' threads, yielding (item, result) in
+    # the order of items. Only a few times 'jobs' items are in flight at once, so
+    # results stream out while 'items' is still being read.
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= jobs * 4:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+
+def parse_datetime(value):
+    # Parses a DATETIME argument in any format dateutil understands; a time without
+    # a timezone is taken as UTC. dateutil is only imported when it is needed.
+    from dateutil import parser
+    dt = parser.parse(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+def parse_timestamp(value):
+    # Parses a Bitbucket ISO 8601 timestamp into seconds since the epoch, None for None.
+    # datetime.fromisoformat reads what Bitbucket sends; anything else goes to dateutil.
+    if value is None:
+        return None
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        return parse_datetime(value).timestamp()
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+def select_deploy_keys(keys, dt, before, creation, lastused):
+    # Evaluates the -b/-a/-c/-l predicates over the whole list of keys at once.
+    # Returns (key, reason) pairs of the keys to delete.
+    cutoff, when = dt.timestamp(), "before" if before else "after"
+    if before:
+        match = lambda t: t is not None and t < cutoff
+    else:
+        match = lambda t: t is not None and t > cutoff
+    by_creation = [ creation and match(parse_timestamp(k['created_on'])) for k in keys ]
+    by_use = [ lastused and match(parse_timestamp(k['last_used'])) for k in keys ]
+    return [ (key, "created %s" % when if c else "last used %s" % when)
+             for key, c, u in zip(keys, by_creation, by_use) if c or u ]
+
+def setup_output():
+    # Standard output is flushed line by line on a terminal, so progress shows up as
+    # it happens; written to a file or a pipe it is buffered into large writes.
+    tty = sys.stdout.isatty()
+    sys.stdout.flush()
+    sys.stdout = io.TextIOWrapper(open(sys.stdout.fileno(), 'wb', OUTPUT_BUFFER_SIZE, closefd=False),
+                                  encoding=sys.stdout.encoding, line_buffering=tty)
+
+class RowWriter:
+    # Writes rows as CSV with a header line, or as JSON Lines: one object per row,
+    # keyed by column name
+    def __init__(self, fp, columns, output_format="csv"):
+        self.fp, self.columns, self.output_format = fp, columns, output_format
+        if output_format == "csv":
+            self.csvw = csv.writer(fp, quoting=csv.QUOTE_NONNUMERIC)
+            self.csvw.writerow(columns)
+
+    def writerow(self, row):
+        if self.output_format == "csv":
+            self.csvw.writerow(row)
+        else:
+            self.fp.write(json.dumps(dict(zip(self.columns, row))) + "\n")
+
+class ResponseCache:
+    # On-disk cache of GET responses, one JSON file per URL (and user), keeping the
+    # ETag and Last-Modified of each so it can be revalidated with a conditional
+    # request. Entries younger than 'ttl' seconds are used without asking at all.
+    def __init__(self, path, ttl=None, user=None):
+        self.path, self.ttl, self.user = path, ttl, user
+        self.hits, self.revalidated, self.misses = 0, 0, 0
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _key(self, text):
+        return hashlib.sha256(("%s %s" % (self.user, text)).encode("utf-8")).hexdigest()
+
+    def _list_key(self, url):
+        # Every page of a list shares the URL without its query string
+        return self._key(urlunsplit(urlsplit(url)[:3] + ("", "")))
+
+    def _file(self, url):
+        return os.path.join(self.path, "%s-%s.json" % (self._list_key(url), self._key(url)))
+
+    def count(self, name):
+        # Pages are fetched on several threads
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def summary(self):
+        return "Cache: %i fresh, %i revalidated, %i downloaded" % (self.hits, self.revalidated, self.misses)
+
+    def get(self, url):
+        try:
+            with open(self._file(url)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return(None)
+        if entry.get('url') != url:
+            return(None)
+        return(entry)
+
+    def fresh(self, entry):
+        return self.ttl is not None and time.time() - entry['fetched'] < self.ttl
+
+    def headers(self, entry):
+        # Headers making a request conditional on the cached entry being out of date
+        headers = {}
+        if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'): headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url, body, etag=None, last_modified=None):
+        entry = { 'url': url, 'fetched': time.time(), 'etag': etag, 'last_modified': last_modified, 'body': body }
+        # Written to a temporary file first, so a reader never sees half an entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, self._file(url))
+
+    def forget(self, url):
+        # Forgets every cached page of the list at url, whatever its query string
+        prefix = self._list_key(url) + "-"
+        for name in os.listdir(self.path):
+            if name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        count = 0
+        for name in os.listdir(self.path):
+            if name.endswith(".json") or name.endswith(".tmp"):
+                os.remove(os.path.join(self.path, name))
+                count += 1
+        return(count)
 
 class ManageBitbucket:
-    csvw = None
+    out = None
+    output_format = "csv"
     stdin_buffer = None
+    session = None
+    cache = None
+    jobs = 1
+    errors = 0
+
+    def __init__(self, jobs=1, retries=5, backoff=1.0, cache_dir=None, cache_ttl=None, output_format="csv"):
+        self.jobs = jobs
+        self.output_format = output_format
+        self.session = self.new_session(retries, backoff, max(10, jobs))
+        if cache_dir is not None:
+            user = self.session.auth[0] if self.session.auth else None
+            self.cache = ResponseCache(cache_dir, cache_ttl, user)
+
+    def new_session(self, retries, backoff, pool_size):
+        # One session for every request, so connections are kept alive and reused.
+        # Requests that get a 429 or 5xx are retried with exponential backoff,
+        # waiting for as long as a Retry-After header asks for.
+        session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        # Look the credentials up in ~/.netrc once, instead of on every request
+        try:
+            auth = netrc.netrc().authenticators(API_HOST)
+        except (IOError, netrc.NetrcParseError):
+            auth = None
+        if auth is not None:
+            session.auth = (auth[0], auth[2])
+        return session
+
+    def writer(self, columns):
+        self.out = RowWriter(sys.stdout, columns, self.output_format)
+        return self.out
+
+    def response_json(self, response):
+        # Raises on an error status; an empty body (like a 204 after a DELETE) is {}
+        response.raise_for_status()
+        if not response.content:
+            return {}
+        return response.json()
 
     def post_api_json(self, url, payload):
-        my_headers['Content-Type'] = 'application/json'
         try:
-            response = requests.post(url, headers=my_headers, data=payload)
-            js = response.json()
+            response = self.session.post(url, headers={'Content-Type': 'application/json'}, data=payload)
+            js = self.response_json(response)
         except Exception as e:
-            if response.status_code > 199 and response.status_code < 300: pass
-            print("Error POSTing page '%s': '%s'" % (url, response), file=sys.stderr)
+            print("Error POSTing page '%s': '%s'" % (url, e), file=sys.stderr)
             return(None)
         return js
 
     def delete_api_json(self, url):
         try:
-            response = requests.api.delete(url)
-            js = response.json()
+            response = self.session.delete(url)
+            js = self.response_json(response)
         except Exception as e:
-            if response.status_code > 199 and response.status_code < 300: pass
-            print("Error DELETEing page '%s': '%s'" % (url, response), file=sys.stderr)
+            print("Error DELETEing page '%s': '%s'" % (url, e), file=sys.stderr)
             return(None)
         return js
 
-    def get_api_json(self, url):
-        next_page_token = None
-        next_page_url = url[:]
-        while next_page_url is not None:
-            try:
-                response = requests.get(next_page_url)
-                page_json = response.json()
-            except Exception as e:
-                if response.status_code > 199 and response.status_code < 300: pass
-                print("Error getting page '%s': '%s'" % (next_page_url, e), file=sys.stderr)
-                return(None)
+    def get_page(self, url):
+        # With a cache, a fresh cached page costs no request, and a stale one a
+        # conditional request that only downloads the page if it changed
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None and self.cache.fresh(entry):
+            self.cache.count('hits')
+            return entry['body']
+        try:
+            response = self.session.get(url, headers=self.cache.headers(entry) if entry is not None else None)
+            if entry is not None and response.status_code == 304:
+                self.cache.count('revalidated')
+                self.cache.put(url, entry['body'], response.headers.get('ETag', entry['etag']),
+                               response.headers.get('Last-Modified', entry['last_modified']))
+                return entry['body']
+            page_json = self.response_json(response)
+        except Exception as e:
+            print("Error getting page '%s': '%s'" % (url, e), file=sys.stderr)
+            self.errors += 1
+            return(None)
+        if self.cache is not None:
+            self.cache.count('misses')
+            self.cache.put(url, page_json, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return page_json
 
+    def get_api_json(self, url, prefetch=True):
+        # Yields every page of a list. With prefetch and self.jobs > 1, once the first
+        # page tells the size of the list the other pages are fetched concurrently by
+        # page number, and still yielded in page order.
+        page_json = self.get_page(url)
+        if page_json is None:
+            return(None)
+        yield page_json
+
+        urls = other_page_urls(page_json) if prefetch and self.jobs > 1 else None
+        if urls is not None:
+            pages = (page for page_url, page in ordered_map(self.get_page, urls, self.jobs))
+        else:
+            pages = self._next_pages(page_json)
+        for page_json in pages:
+            if page_json is None:
+                return(None)
             yield page_json
 
-            next_page_token = page_json.get('next', None)
-            if next_page_token != None:
-                next_page_url = next_page_token
-            else:
-                next_page_url = None
+    def _next_pages(self, page_json):
+        # Follows 'next' links one page after another
+        next_page_url = page_json.get('next', None)
+        while next_page_url is not None:
+            page_json = self.get_page(next_page_url)
+            yield page_json
+            if page_json is None:
+                return(None)
+            next_page_url = page_json.get('next', None)
 
     def load_list(self,arg):
         # arg can be a literal string, or a "file:///path/to/a/file", or "-" to read from stdin.
@@ -66,66 +350,164 @@ class ManageBitbucket:
         args=[arg]
         if arg.startswith("file://"):
             with open(arg[7:]) as f:
-                argss = f.read().splitlines()
+                args = f.read().splitlines()
         elif arg == "-":
             if self.stdin_buffer == None:
                 self.stdin_buffer = sys.stdin.read().splitlines()
             args = self.stdin_buffer
         return(args)
 
-    def _repos(self, args):
+    def _repos(self, args, fields=[f for c, f in REPO_COLUMNS], query=None):
         org = args[0]
-        url = "https://api.bitbucket.org/2.0/repositories/%s" % org
+        url = list_url("https://api.bitbucket.org/2.0/repositories/%s" % org, fields, query)
         for j in self.get_api_json(url):
             if j is None: continue
             if not 'values' in j: continue
             for key in j['values']:
                 yield key
 
-    def _repo_deploy_keys(self, args):
-        org, repos = args[0], self.load_list(args[1])
-        for repo in repos:
-            url = "https://api.bitbucket.org/2.0/repositories/%s/%s/deploy-keys" % (org, repo)
-            for j in self.get_api_json(url):
-                if j is None: continue
-                if not 'values' in j: continue
-                for key in j['values']:
-                    yield key
+    def _all_repo_slugs(self, org):
+        # Streams the slugs of ORG's repositories as their pages arrive
+        for repo in self._repos([org], ["slug"]):
+            yield repo['slug']
+
+    def _repo_deploy_keys(self, org, repos):
+        # Repositories are fetched on self.jobs threads; keys come out in the order of the repositories.
+        # 'repos' can be a generator, so lookups start while it is still being paginated.
+        for repo, keys in ordered_map(lambda repo: list(self._one_repo_deploy_keys(org, repo)), repos, self.jobs):
+            for key in keys:
+                yield key
+
+    def _deploy_keys_url(self, org, repo):
+        return list_url("https://api.bitbucket.org/2.0/repositories/%s/%s/deploy-keys" % (org, repo),
+                        [f for c, f in DEPLOY_KEY_COLUMNS])
+
+    def _one_repo_deploy_keys(self, org, repo):
+        url = self._deploy_keys_url(org, repo)
+        # Repositories are already fetched concurrently, so their pages are not
+        for j in self.get_api_json(url, prefetch=False):
+            if j is None: continue
+            if not 'values' in j: continue
+            for key in j['values']:
+                yield key
 
     def get_repos(self, args):
-        org = args[0]
-        self.csvw = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
-        self.csvw.writerow( [ "slug","name","created_on","updated_on","has_issues","has_wiki" ] )
-        for repo in self._repos(args):
-            self.csvw.writerow( [ 
-                repo['slug'], repo['name'], repo['created_on'], 
-                repo['updated_on'], repo['has_issues'], repo['has_wiki'] 
-            ] )
+        opts, argv = getopt.getopt(args, "s:d")
+        snapshot_file, delta = None, False
+        for o, a in opts:
+            if   o == '-s':  snapshot_file = a
+            elif o == '-d':  delta = True
+        if len(argv) < 1:
+            print("Error: expected ORG", file=sys.stderr)
+            exit(1)
+        if delta and snapshot_file is None:
+            print("Error: -d needs a snapshot file (-s)", file=sys.stderr)
+            exit(1)
+        org = argv[0]
+        if snapshot_file is None:
+            self.writer( [ c for c, f in REPO_COLUMNS ] )
+            for repo in self._repos(argv):
+                self.out.writerow( [ get_field(repo, f) for c, f in REPO_COLUMNS ] )
+            return
+
+        snapshot, changes = self._sync_repos_snapshot(org, snapshot_file)
+        if delta:
+            self.writer( [ "change" ] + [ c for c, f in REPO_COLUMNS ] )
+            for change, row in changes:
+                self.out.writerow( [ change ] + [ row[c] for c, f in REPO_COLUMNS ] )
+        else:
+            self.writer( [ c for c, f in REPO_COLUMNS ] )
+            for slug in sorted(snapshot['repos']):
+                self.out.writerow( [ snapshot['repos'][slug][c] for c, f in REPO_COLUMNS ] )
+
+    def _sync_repos_snapshot(self, org, path):
+        # Brings the snapshot of ORG's repositories in 'path' up to date, fetching only
+        # the repositories updated since the newest 'updated_on' in the snapshot, plus
+        # the slugs of all repositories to notice removed ones. Returns the snapshot and
+        # a list of ("added"|"changed"|"removed", row) changes.
+        snapshot = { 'org': org, 'synced': None, 'repos': {} }
+        if os.path.exists(path):
+            with open(path) as f:
+                snapshot = json.load(f)
+            if snapshot['org'] != org:
+                print("Error: snapshot '%s' is of org '%s', not '%s'" % (path, snapshot['org'], org), file=sys.stderr)
+                exit(1)
+        repos, changes, errors = snapshot['repos'], [], self.errors
+
+        query = "updated_on>=%s" % snapshot['synced'] if snapshot['synced'] is not None else None
+        for repo in self._repos([org], query=query):
+            row = dict( (c, get_field(repo, f)) for c, f in REPO_COLUMNS )
+            old = repos.get(row['slug'], None)
+            if old is None:
+                changes.append(("added", row))
+            elif old != row:
+                changes.append(("changed", row))
+            repos[row['slug']] = row
+        if snapshot['synced'] is not None:
+            slugs = set(self._all_repo_slugs(org))
+            if self.errors == errors:
+                for slug in sorted(set(repos) - slugs):
+                    changes.append(("removed", repos.pop(slug)))
+
+        if self.errors > errors:
+            print("Error: could not list all repositories; not updating snapshot '%s'" % path, file=sys.stderr)
+            exit(1)
+        updated = [ row['updated_on'] for row in repos.values() if row['updated_on'] ]
+        snapshot['synced'] = max(updated) if updated else snapshot['synced']
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+        return snapshot, changes
+
+    def _deploy_key_repos(self, all_repos, argv, usage_args):
+        # Takes ORG REPO ..., or ORG ... with all_repos; returns the org, the repositories
+        # (a generator of every repository in ORG with all_repos), and the rest of argv
+        if len(argv) < (1 if all_repos else 2):
+            print("Error: expected %s" % usage_args, file=sys.stderr)
+            exit(1)
+        if all_repos:
+            return argv[0], self._all_repo_slugs(argv[0]), argv[1:]
+        return argv[0], self.load_list(argv[1]), argv[2:]
 
     def get_repo_deploy_keys(self, args):
-        org, repos = args[0], self.load_list(args[1])
-        self.csvw = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
-        self.csvw.writerow( [ "org", "repo", "id", "type", "created_on", "last_used", "public_key", "comment" ] )
-        for key in self._repo_deploy_keys(args):
-            self.csvw.writerow( [ 
-                org, key['repository']['name'], key['id'], key['type'], key['created_on'], key['last_used'],
-                key['key'].rstrip(), key['comment'].rstrip(), key['label'].rstrip() 
-            ] )
+        opts, argv = getopt.getopt(args, "A", ["all-repos"])
+        org, repos, argv = self._deploy_key_repos(len(opts) > 0, argv, "ORG REPO, or --all-repos ORG")
+        self.writer( [ "org" ] + [ c for c, f in DEPLOY_KEY_COLUMNS ] )
+        for key in self._repo_deploy_keys(org, repos):
+            self.out.writerow( [ org ] + [ get_field(key, f) for c, f in DEPLOY_KEY_COLUMNS ] )
+
+    def _delete_repo_deploy_key(self, org, repo, _id):
+        # Returns None, or the error that kept the key from being deleted
+        url = "https://api.bitbucket.org/2.0/repositories/%s/%s/deploy-keys/%s" % (org, repo, _id)
+        try:
+            self.response_json(self.session.delete(url))
+        except Exception as e:
+            return(e)
+        if self.cache is not None:
+            # No cached page of the key list holds anymore, even within the TTL
+            self.cache.forget(self._deploy_keys_url(org, repo))
+        return(None)
 
     def delete_repo_deploy_key(self, args):
         org, repo, _id = args[0], args[1], args[2]
-        url = "https://api.bitbucket.org/2.0/repositories/%s/%s/deploy-keys/%s" % (org, repo, _id)
-        j = self.delete_api_json(url)
+        error = self._delete_repo_deploy_key(org, repo, _id)
+        if error is not None:
+            print("org='%s' repo='%s': Error deleting key '%s': '%s'" % (org, repo, _id, error), file=sys.stderr)
+            return(False)
         print("org='%s' repo='%s': Deleted key '%s'" % (org, repo, _id))
+        return(True)
 
     def delete_repo_deploy_keys(self, args):
-        opts, argv = getopt.getopt(args, "bacl")
-        before, after, creation, lastused = False, False, False, False
+        opts, argv = getopt.getopt(args, "baclnA", ["all-repos"])
+        before, after, creation, lastused, dry_run, all_repos = False, False, False, False, False, False
         for o, a in opts:
             if   o == '-b':  before   = True
             elif o == '-a':  after    = True
             elif o == '-c':  creation = True
             elif o == '-l':  lastused = True
+            elif o == '-n':  dry_run  = True
+            elif o in ('-A', '--all-repos'):  all_repos = True
 
         if (before == False and after == False) or (before == True and after == True):
             print("Error: you must specify one of -b or -a")
@@ -134,78 +516,144 @@ class ManageBitbucket:
             print("Error: you must specify one of -c or -l")
             exit(1)
 
-        org, repos = argv[0], self.load_list(argv[1])
-        dt = dateutil.parser.parse(argv[2])
-        now = datetime.now(tz.UTC)
-        for key in self._repo_deploy_keys( argv ):
+        org, repos, argv = self._deploy_key_repos(all_repos, argv,
+                                                  "[OPTIONS] ORG REPO DATETIME, or [OPTIONS] --all-repos ORG DATETIME")
+        if len(argv) < 1:
+            print("Error: you must specify a DATETIME", file=sys.stderr)
+            exit(1)
+        dt = parse_datetime(argv[0])
+
+        # Plan first: fetch every key, then select the ones to delete in one pass
+        keys = list(self._repo_deploy_keys(org, repos))
+        plan = select_deploy_keys(keys, dt, before, creation, lastused)
+        if dry_run:
+            self.writer( [ "org", "repo", "id", "reason", "created_on", "last_used" ] )
+            for key, reason in plan:
+                self.out.writerow( [ org, key['repository']['name'], key['id'], "%s %s" % (reason, dt),
+                                     key['created_on'], key['last_used'] ] )
+            print("Would delete %i of %i keys" % (len(plan), len(keys)), file=sys.stderr)
+            return
+        for key, reason in plan:
+            print("org='%s' repo='%s': key id '%s' %s DT '%s'; deleting" % (org, key['repository']['name'], key['id'], reason, dt))
+
+        # Then delete the planned keys on self.jobs threads
+        failed = []
+        delete = lambda key: self._delete_repo_deploy_key(org, key['repository']['name'], key['id'])
+        for key, error in ordered_map(delete, [ key for key, reason in plan ], self.jobs):
             repo = key['repository']['name']
-            creation_d = dateutil.parser.parse(key['created_on']) if key['created_on'] != None else None
-            lastused_d = dateutil.parser.parse(key['last_used']) if key['last_used'] != None else None
-            delete=False
-            if before:
-                if creation and creation_d < dt:
-                    print("org='%s' repo='%s': key id '%s' created before DT '%s'; deleting" % (org, repo, key['id'], dt))
-                    delete=True
-                elif lastused_d != None and lastused and lastused_d < dt:
-                    print("org='%s' repo='%s': key id '%s' last used before DT '%s'; deleting" % (org, repo, key['id'], dt))
-                    delete=True
-            elif after:
-                if creation and creation_d > dt:
-                    print("org='%s' repo='%s': key id '%s' created after DT '%s'; deleting" % (org, repo, key['id'], dt))
-                    delete=True
-                elif lastused_d != None and lastused and lastused_d > dt:
-                    print("org='%s' repo='%s': key id '%s' last used after DT '%s'; deleting" % (org, repo, key['id'], dt))
-                    delete=True
-            if delete == True:
-                self.delete_repo_deploy_key([org, repo, key['id']])
+            if error is not None:
+                print("org='%s' repo='%s': Error deleting key '%s': '%s'" % (org, repo, key['id'], error), file=sys.stderr)
+                failed.append(key)
+            else:
+                print("org='%s' repo='%s': Deleted key '%s'" % (org, repo, key['id']))
+        if len(failed) > 0:
+            print("Error: failed to delete %i keys" % len(failed), file=sys.stderr)
+            exit(1)
 
 def usage():
-    usage_str = """Usage: %s COMMAND [OPTIONS]
+    usage_str = """Usage: %s [-j JOBS] [-o FORMAT] [-C DIR [-T SECONDS]] COMMAND [OPTIONS]
+
+Options:
+  -j JOBS           Number of repositories to fetch, or keys to delete, at the same time
+                    (default: 1). Output stays in the order of the repositories.
+  -o FORMAT         Print listings as "csv" (default) or "jsonl" (JSON Lines, one object
+                    per row keyed by the CSV column names).
+  -C DIR            Cache API responses in DIR (default: $BITBUCKET_CACHE_DIR). Cached pages
+                    are revalidated with their ETag/Last-Modified, so unchanged pages are
+                    not downloaded again.
+  -T SECONDS        Use cached pages younger than SECONDS without asking Bitbucket at all.
 
 Commands:
 
-get_repos ORG
+get_repos [-s SNAPSHOT [-d]] ORG
                     - Gets all repositories for ORG. Prints out a CSV file.
+                      With -s, keeps a snapshot of ORG's repositories in the file SNAPSHOT and
+                      only fetches the repositories updated since the last run (and the names
+                      of all of them, to notice removed ones). With -d, prints only the added,
+                      changed and removed repositories, with a "change" column.
 
 get_repo_deploy_keys ORG REPO
+get_repo_deploy_keys --all-repos ORG
                     - Gets all deploy keys for a repository. REPO can be a single repository,
                       or a "file:///path/to/a/file" to read repositories from, or "-" to read
                       repositories line-by-line from standard input. Prints out a CSV file.
+                      With --all-repos (-A), gets the deploy keys of every repository in ORG,
+                      looking keys up while the repositories are still being listed.
 
 delete_repo_deploy_key ORG REPO ID
                     - Deletes a deploy key ID from ORG/REPO.
 
+clear_cache
+                    - Deletes every cached response from the -C cache directory.
+
 delete_repo_deploy_keys [OPTIONS] ORG REPO DATETIME
+delete_repo_deploy_keys [OPTIONS] --all-repos ORG DATETIME
                     - Deletes any deploy keys in ORG/REPO based on OPTIONS, before or after
                       a DATETIME.
                       REPO can be a single repository, or a "file:///path/to/a/file" to read
                       repositories from, or "-" to read repositories line-by-line from standard
-                      input.
+                      input. With --all-repos (-A), every repository in ORG is checked.
+                      DATETIME can be in any format dateutil understands; without a timezone,
+                      it is in UTC.
                       The following OPTIONS modify what keys to select based on DATETIME:
                         -b      Keys created before the DATETIME
                         -a      Keys created after the DATETIME
                         -c      DATETIME refers to the creation date
                         -l      DATETIME refers to the last used date
+                        -n      Dry run: print the keys that would be deleted (in the -o
+                                format) instead of deleting them
 
 """ % sys.argv[0]
     print(usage_str)
     exit(1)
 
 def main():
-    o = ManageBitbucket()
-
-    if len(sys.argv) < 2:
-        usage()
-    elif sys.argv[1] == "get_repos":
-        o.get_repos(sys.argv[2:])
-    elif sys.argv[1] == "get_repo_deploy_keys":
-        o.get_repo_deploy_keys(sys.argv[2:])
-    elif sys.argv[1] == "delete_repo_deploy_key":
-        o.delete_repo_deploy_key(sys.argv[2:])
-    elif sys.argv[1] == "delete_repo_deploy_keys":
-        o.delete_repo_deploy_keys(sys.argv[2:])
-    else:
+    try:
+        opts, argv = getopt.getopt(sys.argv[1:], "j:o:C:T:")
+    except getopt.GetoptError as e:
+        print("Error: %s" % e, file=sys.stderr)
         usage()
+    jobs, output_format, cache_dir, cache_ttl = 1, "csv", os.environ.get("BITBUCKET_CACHE_DIR", None), None
+    for o, a in opts:
+        if   o == '-j':  jobs = int(a)
+        elif o == '-o':  output_format = a
+        elif o == '-C':  cache_dir = a
+        elif o == '-T':  cache_ttl = float(a)
+
+    if output_format not in OUTPUT_FORMATS:
+        print("Error: unknown output format '%s'" % output_format, file=sys.stderr)
+        exit(1)
+    if cache_ttl is not None and cache_dir is None:
+        print("Error: -T needs a cache directory (-C)", file=sys.stderr)
+        exit(1)
+
+    setup_output()
+    o = ManageBitbucket(jobs=jobs, cache_dir=cache_dir, cache_ttl=cache_ttl, output_format=output_format)
+
+    try:
+        if len(argv) < 1:
+            usage()
+        elif argv[0] == "clear_cache":
+            if o.cache is None:
+                print("Error: no cache directory given (-C)", file=sys.stderr)
+                exit(1)
+            print("Removed %i cached responses from %s" % (o.cache.clear(), o.cache.path))
+        elif argv[0] == "get_repos":
+            o.get_repos(argv[1:])
+        elif argv[0] == "get_repo_deploy_keys":
+            o.get_repo_deploy_keys(argv[1:])
+        elif argv[0] == "delete_repo_deploy_key":
+            if not o.delete_repo_deploy_key(argv[1:]):
+                exit(1)
+        elif argv[0] == "delete_repo_deploy_keys":
+            o.delete_repo_deploy_keys(argv[1:])
+        else:
+            usage()
+    finally:
+        # How many pages the cache saved, once the listing is out
+        if o.cache is not None and o.cache.hits + o.cache.revalidated + o.cache.misses:
+            sys.stdout.flush()
+            print(o.cache.summary(), file=sys.stderr)
 
 if __name__ == "__main__":
     main()
@@ -4,21 +4,64 @@
 import os
 import sys
 import csv
+import getopt
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 headers = {
         'Circle-Token': os.environ["CIRCLE_TOKEN"]
 }
 
+def ordered_map(func, items, jobs=1):
+    # Apply func to items on a pool of 'jobs' threads, yielding (item, result) in
+    # the order of items. Only a few times 'jobs' items are in flight at once, so
+    # results stream out while 'items' is still being read.
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= jobs * 4:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+
 class ManageCircleSecrets:
     csvw = None
+    session = None
+    jobs = 1
+
+    def __init__(self, jobs=1, retries=5, backoff=1.0):
+        self.jobs = jobs
+        self.session = self.new_session(retries, backoff, max(10, jobs))
+
+    def new_session(self, retries, backoff, pool_size):
+        # One session for every request, so connections are kept alive and reused.
+        # Requests that get a 429 or 5xx are retried with exponential backoff,
+        # waiting for as long as a Retry-After header asks for.
+        session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.headers.update(headers)
+        return session
 
     def post_api_json(self, url, payload):
         my_headers = headers.copy()
         my_headers['Content-Type'] = 'application/json'
         try:
-            response = requests.post(url, headers=my_headers, data=payload)
+            response = self.session.post(url, headers=my_headers, data=payload)
         except:
             print("Error deleting page '%s': '%s'" % (url, response), file=sys.stderr)
             return(None)
@@ -26,7 +69,7 @@ class ManageCircleSecrets:
 
     def delete_api_json(self, url):
         try:
-            response = requests.api.delete(url, headers=headers)
+            response = self.session.delete(url)
         except:
             print("Error deleting page '%s': '%s'" % (url, response), file=sys.stderr)
             return(None)
@@ -37,17 +80,20 @@ class ManageCircleSecrets:
         next_page_url = url[:]
         while next_page_url is not None:
             try:
-                response = requests.get(next_page_url, headers=headers)
+                response = self.session.get(next_page_url)
             except:
                 print("Error getting page '%s'" % next_page_url, file=sys.stderr)
                 return(None)
+            if not response.ok:
+                print("Error getting page '%s': HTTP %i" % (next_page_url, response.status_code), file=sys.stderr)
+                return(None)
 
             page_json = response.json()
             yield page_json
 
             next_page_token = page_json.get('next_page_token', None)
             if next_page_token != None:
-                next_page_url = url[:] + "&page-token=%s" % next_page_token
+                next_page_url = url[:] + ("&" if "?" in url else "?") + "page-token=%s" % next_page_token
             else:
                 next_page_url = None
 
@@ -58,35 +104,39 @@ class ManageCircleSecrets:
         args=[arg]
         if arg.startswith("file://"):
             with open(arg[7:]) as f:
-                argss = f.read().splitlines()
+                args = f.read().splitlines()
         elif arg == "-":
             args = sys.stdin.read().splitlines()
         return args
 
+    def _project_items(self, vcs, org, projects, endpoint):
+        # Projects are fetched on self.jobs threads; yields (project, items) in the order of the projects
+        def fetch(proj):
+            url = "https://circleci.com/api/v2/project/%s/%s/%s/%s" % (vcs, org, proj, endpoint)
+            items = []
+            for j in self.get_api_json(url):
+                if j is None: continue
+                if not 'items' in j: continue
+                items.extend(j['items'])
+            return items
+        return ordered_map(fetch, projects, self.jobs)
+
     def get_project_vars(self, args):
         vcs, org, projects = args[0], args[1], self.load_list(args[2])
         self.csvw = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
         self.csvw.writerow( [ "vcs", "org", "project", "name", "value" ] )
-        for proj in projects:
-            url = "https://circleci.com/api/v2/project/%s/%s/%s/envvar" % (vcs, org, proj)
-            for j in self.get_api_json(url):
-                if j is None: continue
-                if not 'items' in j: continue
-                for key in j['items']:
-                    self.csvw.writerow( [ vcs, org, proj, key['name'], key['value'] ] )
+        for proj, items in self._project_items(vcs, org, projects, "envvar"):
+            for key in items:
+                self.csvw.writerow( [ vcs, org, proj, key['name'], key['value'] ] )
 
     def get_checkout_keys(self, args):
         # project can be a single project, or a "file:///path/to/a/file", or "-" to read from stdin
         vcs, org, projects = args[0], args[1], self.load_list(args[2])
         self.csvw = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
         self.csvw.writerow( [ "vcs", "org", "project", "key_type", "key_preferred", "key_created_at", "public_key", "key_fingerprint" ] )
-        for proj in projects:
-            url = "https://circleci.com/api/v2/project/%s/%s/%s/checkout-key" % (vcs, org, proj)
-            for j in self.get_api_json(url):
-                if j is None: continue
-                if not 'items' in j: continue
-                for key in j['items']:
-                    self.csvw.writerow( [ vcs, org, proj, key['type'], key['preferred'], key['created_at'], key['public_key'].rstrip(), key['fingerprint'] ] )
+        for proj, items in self._project_items(vcs, org, projects, "checkout-key"):
+            for key in items:
+                self.csvw.writerow( [ vcs, org, proj, key['type'], key['preferred'], key['created_at'], key['public_key'].rstrip(), key['fingerprint'] ] )
 
     def create_checkout_key(self, args):
         vcs, org, project = args[0], args[1], args[2]
@@ -110,7 +160,11 @@ class ManageCircleSecrets:
 
 
 def usage():
-    usage_str = """Usage: %s COMMAND [OPTIONS]
+    usage_str = """Usage: %s [-j JOBS] COMMAND [OPTIONS]
+
+Options:
+  -j, --jobs JOBS   Number of projects to fetch at the same time (default: 1).
+                    Output stays in the order of the projects.
 
 Commands:
 
@@ -137,20 +191,29 @@ get_project_vars VCS ORG PROJECT
     exit(1)
 
 def main():
-    o = ManageCircleSecrets()
+    try:
+        opts, argv = getopt.getopt(sys.argv[1:], "j:", ["jobs="])
+    except getopt.GetoptError as e:
+        print("Error: %s" % e, file=sys.stderr)
+        usage()
+    jobs = 1
+    for o, a in opts:
+        if o in ('-j', '--jobs'):  jobs = int(a)
+
+    o = ManageCircleSecrets(jobs=jobs)
 
-    if len(sys.argv) < 2:
+    if len(argv) < 1:
         usage()
-    elif sys.argv[1] == "get_checkout_keys":
-        o.get_checkout_keys(sys.argv[2:])
-    elif sys.argv[1] == "create_checkout_key":
-        o.create_checkout_key(sys.argv[2:])
-    elif sys.argv[1] == "delete_checkout_key":
-        o.delete_checkout_key(sys.argv[2:])
-    elif sys.argv[1] == "rotate_checkout_key":
-        o.rotate_checkout_key(sys.argv[2:])
-    elif sys.argv[1] == "get_project_vars":
-        o.get_project_vars(sys.argv[2:])
+    elif argv[0] == "get_checkout_keys":
+        o.get_checkout_keys(argv[1:])
+    elif argv[0] == "create_checkout_key":
+        o.create_checkout_key(argv[1:])
+    elif argv[0] == "delete_checkout_key":
+        o.delete_checkout_key(argv[1:])
+    elif argv[0] == "rotate_checkout_key":
+        o.rotate_checkout_key(argv[1:])
+    elif argv[0] == "get_project_vars":
+        o.get_project_vars(argv[1:])
     else:
         usage()
 
@@ -8,45 +8,202 @@ Usage:
 Shut down your registry service to avoid race conditions and possible data loss
 and then run the command with an image repo like this:
 delete_docker_registry_image.py --image awesomeimage --dry-run
+
+To clean up many images in one run, list one image[:tag] per line in a file
+(or pipe them in with '-'):
+delete_docker_registry_image.py --batch targets.txt --dry-run
+
+To see what a cleanup would reclaim before running it, write the plan out
+during a dry run and execute it later without scanning the registry again:
+delete_docker_registry_image.py --batch targets.txt --dry-run --plan-file plan.json
+delete_docker_registry_image.py --execute-plan plan.json
+
+To apply retention rules (keep the newest N tags, delete tags older than X
+days, protect tags matching a regex) to every repository in one scan:
+delete_docker_registry_image.py --policy retention.json --dry-run
+
+To check blobs for corruption, missing blobs and unreferenced blobs:
+delete_docker_registry_image.py --verify --jobs 8 --verify-state verify.state
+
+To split a long cleanup into time-boxed windows, journal the deletions and
+resume the journaled plan later without scanning the registry again:
+delete_docker_registry_image.py --batch targets.txt --journal cleanup.journal --time-limit 600
+delete_docker_registry_image.py --resume --journal cleanup.journal --time-limit 600
+
+To see where a run spends its time and how much I/O it does, write phase
+timings and counters as JSON to a file (or '-' for stderr):
+delete_docker_registry_image.py --batch targets.txt --metrics-file -
 """
 
 import argparse
+import functools
+import hashlib
+import heapq
 import json
 import logging
 import os
+import re
 import sys
 import shutil
-import glob
+import time
+import sqlite3
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
+# Deletions run phase by phase: everything that references a blob goes before
+# the blob itself, so an interrupted run never leaves a tag or a revision
+# pointing at a blob that is already gone.
+PHASE_TAGS, PHASE_REVISIONS, PHASE_LAYERS, PHASE_BLOBS = range(4)
+PHASE_NAMES = ["tags", "revisions", "layers", "blobs"]
 
-def del_empty_dirs(s_dir, top_level):
-    """recursively delete empty directories"""
-    b_empty = True
+# read size when re-hashing blobs for --verify
+HASH_BUFFER_SIZE = 4 * 1024 * 1024
+
+LINK_TAG, LINK_INDEX, LINK_REVISION, LINK_LAYER = "tag", "index", "revision", "layer"
+
+# one link file found by scan_links. name is the tag for tag and index links,
+# the digest directory for revision and layer links. digest is None for a tag
+# directory without a current/link.
+Link = namedtuple("Link", ["kind", "name", "digest", "path"])
+
+DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+
+
+class Metrics(object):
+    """wall time per phase and I/O counters of one run, for --metrics-file
+
+    Phases nest: time spent in an inner phase is not counted towards the
+    phase around it, so the phases add up to the time measured. Counters can
+    be bumped from worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.phases = {}
+        self._stack = []
 
-    for s_target in os.listdir(s_dir):
-        s_path = os.path.join(s_dir, s_target)
-        if os.path.isdir(s_path):
-            if not del_empty_dirs(s_path, False):
-                b_empty = False
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _charge(self, now):
+        if self._stack:
+            name, since = self._stack[-1]
+            self.phases[name] = self.phases.get(name, 0.0) + now - since
+            self._stack[-1] = (name, now)
+
+    @contextmanager
+    def phase(self, name):
+        """time the block as phase name"""
+        with self._lock:
+            now = time.time()
+            self._charge(now)
+            self._stack.append((name, now))
+        try:
+            yield
+        finally:
+            with self._lock:
+                now = time.time()
+                self._charge(now)
+                self._stack.pop()
+                if self._stack:
+                    self._stack[-1] = (self._stack[-1][0], now)
+
+    def summary(self):
+        with self._lock:
+            seconds = time.time() - self.started
+            phases = dict((name, round(value, 6)) for name, value in self.phases.items())
+            phases["other"] = round(max(0.0, seconds - sum(self.phases.values())), 6)
+            return {"seconds": round(seconds, 6), "phases": phases, "counters": dict(self.counters)}
+
+    def write(self, path):
+        """write summary() as JSON, '-' for stderr"""
+        summary = self.summary()
+        if path == "-":
+            json.dump(summary, sys.stderr, indent=2, sort_keys=True)
+            sys.stderr.write("\n")
         else:
-            b_empty = False
+            with open(path, "w") as metrics_file:
+                json.dump(summary, metrics_file, indent=2, sort_keys=True)
+        return summary
+
+
+metrics = Metrics()
+
 
-    if b_empty:
-        logger.debug("Deleting empty directory '%s'", s_dir)
-        if not top_level:
-            os.rmdir(s_dir)
+def del_empty_dirs(s_dir, top_level):
+    """delete empty directories below s_dir, bottom-up and without recursion"""
+    b_empty = True
+    removed = set()
+
+    for root, dirs, files in os.walk(s_dir, topdown=False):
+        metrics.count("dirs_listed")
+        children = [os.path.join(root, each) for each in dirs]
+        empty = not files and all(child in removed for child in children)
+        removed.difference_update(children)
+        if root == s_dir:
+            b_empty = empty
+        if empty:
+            logger.debug("Deleting empty directory '%s'", root)
+            if root != s_dir or not top_level:
+                os.rmdir(root)
+                removed.add(root)
 
     return b_empty
 
 
+def del_empty_parents(paths, top_dir, dry_run=False):
+    """delete directories left empty by deleting paths, walking up towards top_dir
+
+    Only the parents of paths are looked at, deepest first. In a dry run paths
+    count as deleted, and the directories that would be deleted are logged.
+    """
+    top_dir = os.path.normpath(top_dir)
+    gone = set(os.path.normpath(path) for path in paths)
+    queued = set(os.path.dirname(path) for path in gone)
+    pending = [(-s_dir.count(os.sep), s_dir) for s_dir in queued]
+    heapq.heapify(pending)
+    while pending:
+        _, s_dir = heapq.heappop(pending)
+        if not s_dir.startswith(top_dir + os.sep) or s_dir in gone:
+            continue
+        try:
+            entries = os.listdir(s_dir)
+        except OSError:
+            continue
+        metrics.count("dirs_listed")
+        if any(os.path.join(s_dir, each) not in gone for each in entries):
+            continue
+        if dry_run:
+            logger.info("DRY_RUN: would have deleted empty directory '%s'", s_dir)
+        else:
+            logger.debug("Deleting empty directory '%s'", s_dir)
+            try:
+                os.rmdir(s_dir)
+            except OSError as error:
+                logger.critical("Failed to delete directory:%s", error)
+                continue
+        gone.add(s_dir)
+        parent = os.path.dirname(s_dir)
+        if parent not in queued:
+            queued.add(parent)
+            heapq.heappush(pending, (-parent.count(os.sep), parent))
+
+
 def get_layers_from_blob(path):
     """parse json blob and get set of layer digests"""
     try:
         with open(path, "r") as blob:
+            metrics.count("files_opened")
             data_raw = blob.read()
             data = json.loads(data_raw)
+            metrics.count("manifests_parsed")
             if data["schemaVersion"] == 1:
                 result = set([entry["blobSum"].split(":")[1] for entry in data["fsLayers"]])
             else:
@@ -59,216 +216,1052 @@ def get_layers_from_blob(path):
         return set()
 
 
-def get_digest_from_blob(path):
-    """parse file and get digest"""
+def is_digest(digest):
+    """check that digest is a sha256 hex digest, so paths built from it stay inside one blob or link"""
+    return digest is not None and DIGEST_RE.fullmatch(digest) is not None
+
+
+def read_link(path):
+    """get the digest from a link file, None if there is no such file"""
     try:
         with open(path, "r") as blob:
+            metrics.count("files_opened")
             return blob.read().split(":")[1]
+    except (IOError, OSError) as error:
+        if not os.path.exists(path):
+            return None
+        logger.critical("Failed to read digest from blob:%s", error)
+        return ""
     except Exception as error:
         logger.critical("Failed to read digest from blob:%s", error)
         return ""
 
 
-def get_links(path, _filter=None):
-    """recursively walk `path` and parse every link inside"""
+def ordered_map(func, items, jobs=1, executor=ThreadPoolExecutor):
+    """apply func to items on a pool of `jobs` workers, yielding (item, result) in input order
+
+    At most a few times `jobs` items are in flight, so `items` can be a long
+    generator without everything being queued up front. Pass
+    executor=ProcessPoolExecutor for CPU bound work.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    with executor(max_workers=jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= jobs * 4:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+
+
+def hash_blob(path):
+    """sha256 hex digest of a file read in large chunks, None if it cannot be read"""
+    digest = hashlib.sha256()
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    try:
+        with open(path, "rb", buffering=0) as blob:
+            while True:
+                size = blob.readinto(buf)
+                if not size:
+                    break
+                digest.update(view[:size])
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+def remove_tree(path):
+    """shutil.rmtree that returns the error instead of raising it"""
+    try:
+        shutil.rmtree(path)
+    except Exception as error:
+        return error
+    return None
+
+
+def list_dirs(path):
+    """names of the directories in path, using scandir's file types instead of a stat per entry"""
+    try:
+        with os.scandir(path) as entries:
+            metrics.count("dirs_listed")
+            return [entry.name for entry in entries if entry.is_dir()]
+    except OSError:
+        return []
+
+
+def scan_links(path, read=read_link):
+    """find the links of the repository at path, only listing the registry v2 layout:
+
+    _manifests/tags/<tag>/current/link
+    _manifests/tags/<tag>/index/sha256/<digest>/link
+    _manifests/revisions/sha256/<digest>/link
+    _layers/sha256/<digest>/link
+    """
     result = []
-    for root, _, files in os.walk(path):
-        for each in files:
-            if each == "link":
-                filepath = os.path.join(root, each)
-                if not _filter or _filter in filepath:
-                    result.append(get_digest_from_blob(filepath))
+    tags_dir = os.path.join(path, "_manifests", "tags")
+    for tag in list_dirs(tags_dir):
+        link = os.path.join(tags_dir, tag, "current", "link")
+        result.append(Link(LINK_TAG, tag, read(link), link))
+        index_dir = os.path.join(tags_dir, tag, "index", "sha256")
+        for digest in list_dirs(index_dir):
+            link = os.path.join(index_dir, digest, "link")
+            result.append(Link(LINK_INDEX, tag, read(link), link))
+    for kind, links_dir in ((LINK_REVISION, os.path.join(path, "_manifests", "revisions", "sha256")),
+                            (LINK_LAYER, os.path.join(path, "_layers", "sha256"))):
+        for digest in list_dirs(links_dir):
+            link = os.path.join(links_dir, digest, "link")
+            result.append(Link(kind, digest, read(link), link))
+    return [link for link in result if link.digest is not None or link.kind == LINK_TAG]
+
+
+def scan_repository(path, read=read_link):
+    """scan one repository into a RepositoryRefs"""
+    result = RepositoryRefs(path)
+    for link in scan_links(path, read):
+        result.add(link)
     return result
 
 
+class LinkIndex(object):
+    """sqlite cache of link digests and manifest layers, keyed by path and mtime
+
+    Every run bumps a generation number. Links seen by a run are stamped with
+    it, so after a full scan the rows of links that disappeared can be dropped.
+    """
+
+    def __init__(self, path, rebuild=False):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if rebuild:
+            logger.info("Rebuilding index %s", path)
+            self.db.execute("DROP TABLE IF EXISTS links")
+            self.db.execute("DROP TABLE IF EXISTS manifests")
+            self.db.execute("DROP TABLE IF EXISTS meta")
+        self.db.execute("CREATE TABLE IF NOT EXISTS links "
+                        "(path TEXT PRIMARY KEY, mtime REAL, digest TEXT, generation INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS manifests "
+                        "(digest TEXT PRIMARY KEY, mtime REAL, layers TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        self.generation = (row[0] if row else 0) + 1
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (self.generation,))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def read_link(self, path):
+        """get the digest of a link file, reading it only if it changed since the last run"""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return read_link(path)
+        with self._lock:
+            row = self.db.execute("SELECT mtime, digest FROM links WHERE path = ?", (path,)).fetchone()
+            if row is not None and row[0] == mtime:
+                self.hits += 1
+            else:
+                self.misses += 1
+        digest = row[1] if row is not None and row[0] == mtime else read_link(path)
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?)",
+                            (path, mtime, digest, self.generation))
+        return digest
+
+    def manifest_layers(self, digest, path):
+        """get the layers of a manifest blob, parsing it only if it changed since the last run"""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return get_layers_from_blob(path)
+        with self._lock:
+            row = self.db.execute("SELECT mtime, layers FROM manifests WHERE digest = ?",
+                                  (digest,)).fetchone()
+            if row is not None and row[0] == mtime:
+                self.hits += 1
+                return set(row[1].split())
+            self.misses += 1
+        layers = get_layers_from_blob(path)
+        if layers:
+            with self._lock:
+                self.db.execute("INSERT OR REPLACE INTO manifests VALUES (?, ?, ?)",
+                                (digest, mtime, " ".join(sorted(layers))))
+        return layers
+
+    def forget_blob(self, digest):
+        """drop a deleted manifest blob"""
+        self.db.execute("DELETE FROM manifests WHERE digest = ?", (digest,))
+
+    def forget_unseen(self):
+        """drop links a full scan did not find anymore"""
+        self.db.execute("DELETE FROM links WHERE generation < ?", (self.generation,))
+
+    def close(self):
+        logger.debug("Index %s: %d hits, %d misses", self.path, self.hits, self.misses)
+        metrics.count("index_hits", self.hits)
+        metrics.count("index_misses", self.misses)
+        self.db.commit()
+        self.db.close()
+
+
+class RepositoryRefs(object):
+    """every link found inside one repository"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tags = {}          # tag -> digest of current/link
+        self.tag_indexes = {}   # tag -> set of digests in index/sha256
+        self.revisions = set()  # digests in _manifests/revisions/sha256
+        self.layers = set()     # digests in _layers/sha256
+        self.counts = {}        # digest -> number of links to it in this repository
+
+    def add(self, link):
+        """file a Link found by scan_links"""
+        if link.kind in (LINK_TAG, LINK_INDEX):
+            self.tag_indexes.setdefault(link.name, set())
+        if link.digest is None:
+            return
+        if not link.digest:
+            # read_link already reported it; an unreadable link must not pass for a digest
+            logger.critical("Ignoring unreadable link %s", link.path)
+            return
+        if link.kind == LINK_TAG:
+            self.tags[link.name] = link.digest
+        elif link.kind == LINK_INDEX:
+            self.tag_indexes[link.name].add(link.digest)
+        elif link.kind == LINK_REVISION:
+            self.revisions.add(link.digest)
+        elif link.kind == LINK_LAYER:
+            self.layers.add(link.digest)
+        self.counts[link.digest] = self.counts.get(link.digest, 0) + 1
+
+    def _unlink(self, digest, count=1):
+        """drop `count` references to digest, returns True when none are left"""
+        left = self.counts.get(digest, 0) - count
+        if left > 0:
+            self.counts[digest] = left
+            return False
+        self.counts.pop(digest, None)
+        return True
+
+    def links(self):
+        """set of every digest linked from this repository"""
+        return set(self.counts)
+
+    def tag_links(self, tag):
+        """digests linked from the current and index links of a tag"""
+        result = set(self.tag_indexes.get(tag, ()))
+        if tag in self.tags:
+            result.add(self.tags[tag])
+        return result
+
+
+class TagIndex(object):
+    """which tags of one repository use each manifest and each layer"""
+
+    def __init__(self):
+        self.manifest_tags = {}  # manifest digest -> set of tags
+        self.layer_tags = {}     # layer digest -> set of tags
+        self.tag_digests = {}    # tag -> (manifest digest, layer digests)
+
+    def add_tag(self, tag, manifest, layers):
+        self.tag_digests[tag] = (manifest, layers)
+        self.manifest_tags.setdefault(manifest, set()).add(tag)
+        for layer in layers:
+            self.layer_tags.setdefault(layer, set()).add(tag)
+
+    def remove_tag(self, tag):
+        if tag not in self.tag_digests:
+            return
+        manifest, layers = self.tag_digests.pop(tag)
+        for index, digests in ((self.manifest_tags, [manifest]), (self.layer_tags, layers)):
+            for digest in digests:
+                index[digest].discard(tag)
+                if not index[digest]:
+                    del index[digest]
+
+    def manifest_in_other_tag(self, manifest, tag):
+        return bool(self.manifest_tags.get(manifest, set()) - set([tag]))
+
+    def layer_in_other_tag(self, layer, tag):
+        return bool(self.layer_tags.get(layer, set()) - set([tag]))
+
+
+class ReferenceGraph(object):
+    """in-memory view of all repositories, tags, manifests and layers in a registry"""
+
+    def __init__(self):
+        self.repos = {}
+        self.refcounts = {}  # digest -> set of repositories linking to it
+        self.removed = set()  # repositories deleted during this run
+
+    def add_repository(self, repo, refs):
+        """register the links of a scanned repository"""
+        self.repos[repo] = refs
+        for digest in refs.counts:
+            self.refcounts.setdefault(digest, set()).add(repo)
+
+    def linked_elsewhere(self, digest, repo):
+        """check if any repository other than repo links to digest"""
+        return bool(self.refcounts.get(digest, set()) - set([repo]))
+
+    def tagged_manifests(self):
+        """manifest digests referenced by the current link of any tag in any repository"""
+        result = set()
+        for refs in self.repos.values():
+            result.update(refs.tags.values())
+        return result
+
+    def _release(self, repo, digest, count=1):
+        if self.repos[repo]._unlink(digest, count):
+            holders = self.refcounts.get(digest)
+            if holders is not None:
+                holders.discard(repo)
+                if not holders:
+                    del self.refcounts[digest]
+
+    def remove_layer(self, repo, digest):
+        """forget a _layers link"""
+        refs = self.repos[repo]
+        if digest in refs.layers:
+            refs.layers.discard(digest)
+            self._release(repo, digest)
+
+    def remove_revision(self, repo, digest):
+        """forget a _manifests/revisions link"""
+        refs = self.repos[repo]
+        if digest in refs.revisions:
+            refs.revisions.discard(digest)
+            self._release(repo, digest)
+
+    def remove_tag_index(self, repo, tag, digest):
+        """forget one index link of a tag"""
+        refs = self.repos[repo]
+        if digest in refs.tag_indexes.get(tag, ()):
+            refs.tag_indexes[tag].discard(digest)
+            self._release(repo, digest)
+
+    def remove_tag(self, repo, tag):
+        """forget a tag with its current and index links"""
+        refs = self.repos[repo]
+        for digest in refs.tag_indexes.pop(tag, set()):
+            self._release(repo, digest)
+        if tag in refs.tags:
+            self._release(repo, refs.tags.pop(tag))
+
+    def remove_repository(self, repo):
+        """forget a repository and every link inside it"""
+        refs = self.repos.pop(repo, None)
+        self.removed.add(repo)
+        if refs is None:
+            return
+        for digest in refs.counts:
+            holders = self.refcounts.get(digest)
+            if holders is not None:
+                holders.discard(repo)
+                if not holders:
+                    del self.refcounts[digest]
+
+
+class DeletionPlan(object):
+    """directories queued for deletion, executed together in one pass"""
+
+    def __init__(self, paths=()):
+        self.paths = []
+        self._queued = set()
+        self.targets = []
+        for path in paths:
+            self.add(path)
+
+    def start_target(self, repository, tag, action):
+        """attribute the deletions and kept blobs that follow to one image"""
+        self.targets.append({"repository": repository, "tag": tag, "action": action,
+                             "deleted": [], "kept": {}})
+
+    def add(self, path):
+        if path not in self._queued:
+            self._queued.add(path)
+            self.paths.append(path)
+            if self.targets:
+                self.targets[-1]["deleted"].append(path)
+
+    def keep(self, digest, reason):
+        """note a blob the current target uses but cannot free"""
+        if self.targets:
+            self.targets[-1]["kept"].setdefault(digest, reason)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def phases(self, registry_data_dir):
+        """split the plan into deletion phases, dropping paths inside another queued directory"""
+        result = [[] for _ in PHASE_NAMES]
+        for path in self.paths:
+            parent = os.path.dirname(path)
+            while len(parent) > len(registry_data_dir) and parent not in self._queued:
+                parent = os.path.dirname(parent)
+            if parent in self._queued:
+                continue
+            parts = os.path.relpath(path, registry_data_dir).split(os.sep)
+            if parts[0] == "blobs":
+                result[PHASE_BLOBS].append(path)
+            elif parts[-3:-1] == ["_layers", "sha256"]:
+                result[PHASE_LAYERS].append(path)
+            elif parts[-4:-1] == ["_manifests", "revisions", "sha256"]:
+                result[PHASE_REVISIONS].append(path)
+            else:
+                result[PHASE_TAGS].append(path)
+        return result
+
+
+class DeletionJournal(object):
+    """append-only JSON lines journal of planned and completed deletions
+
+    A plan line lists every deletion of a plan in execution order, then one
+    line follows per deletion done or failed, and a complete line once every
+    phase ran. A plan without a complete line can be resumed: its deletions
+    that have no done line yet are what is left to do.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def pending(self):
+        """(plan line, set of paths done) of the last plan if it did not complete, else None"""
+        plan, done = None, set()
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                if entry["event"] == "plan":
+                    plan, done = entry, set()
+                elif entry["event"] == "deleted" and plan is not None:
+                    done.add(entry["path"])
+                elif entry["event"] == "complete":
+                    plan = None
+        if plan is None:
+            return None
+        return plan, done
+
+    def _write(self, entry):
+        if self._file is None:
+            cut = False
+            if os.path.exists(self.path) and os.path.getsize(self.path):
+                with open(self.path, "rb") as journal:
+                    journal.seek(-1, os.SEEK_END)
+                    cut = journal.read(1) != b"\n"
+            self._file = open(self.path, "a")
+            if cut:
+                # don't append to a line cut short by a crash
+                self._file.write("\n")
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def start(self, registry_data_dir, paths):
+        self._write({"event": "plan", "registry_data_dir": registry_data_dir,
+                     "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                     "deletions": paths})
+        self.sync()
+
+    def record(self, path, error=None):
+        if error is None:
+            self._write({"event": "deleted", "path": path})
+        else:
+            self._write({"event": "failed", "path": path, "error": str(error)})
+
+    def finish(self):
+        self._write({"event": "complete"})
+        self.sync()
+
+    def sync(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def batched(method):
+    """run a RegistryCleaner method inside a batch, so its deletions execute in one pass"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.batch():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class RegistryCleanerError(Exception):
     pass
 
 
+class RetentionRule(object):
+    """one rule of a RetentionPolicy"""
+
+    KEYS = ("repositories", "keep_newest", "older_than_days", "protect", "untagged")
+
+    def __init__(self, rule):
+        if not isinstance(rule, dict):
+            raise RegistryCleanerError("Retention rule must be an object, not {0!r}".format(rule))
+        unknown = set(rule) - set(self.KEYS)
+        if unknown:
+            raise RegistryCleanerError("Unknown retention rule keys: {0}".format(", ".join(sorted(unknown))))
+        for key, value in (("repositories", rule.get("repositories", ".*")), ("protect", rule.get("protect"))):
+            if (value is None and key == "repositories") or (value is not None and not isinstance(value, str)):
+                raise RegistryCleanerError("Retention rule {0} must be a regular expression string, "
+                                           "not {1!r}".format(key, value))
+        try:
+            self.repositories = re.compile(rule.get("repositories", ".*"))
+            self.protect = re.compile(rule["protect"]) if rule.get("protect") else None
+        except re.error as error:
+            raise RegistryCleanerError("Bad regular expression in retention rule: {0}".format(error))
+        self.keep_newest = rule.get("keep_newest")
+        self.older_than_days = rule.get("older_than_days")
+        # bool is an int too, but true/false is no count of tags or days
+        if self.keep_newest is not None and (not isinstance(self.keep_newest, int) or
+                                             isinstance(self.keep_newest, bool) or self.keep_newest < 0):
+            raise RegistryCleanerError("Retention rule keep_newest must be a non-negative integer, "
+                                       "not {0!r}".format(self.keep_newest))
+        if self.older_than_days is not None and (not isinstance(self.older_than_days, (int, float)) or
+                                                 isinstance(self.older_than_days, bool)):
+            raise RegistryCleanerError("Retention rule older_than_days must be a number, "
+                                       "not {0!r}".format(self.older_than_days))
+
+        self.untagged = bool(rule.get("untagged", False))
+
+    def matches(self, repo):
+        return self.repositories.fullmatch(repo) is not None
+
+    def expired_tags(self, tag_mtimes, now):
+        """tags this rule deletes from a repository, given {tag: mtime}, oldest first"""
+        if self.keep_newest is None and self.older_than_days is None:
+            return []
+        tags = [t for t in tag_mtimes if self.protect is None or not self.protect.search(t)]
+        tags.sort(key=lambda t: (tag_mtimes[t], t), reverse=True)
+        result = []
+        for tag in tags[self.keep_newest or 0:]:
+            if self.older_than_days is not None and \
+                    now - tag_mtimes[tag] < self.older_than_days * 86400:
+                continue
+            result.append(tag)
+        return list(reversed(result))
+
+
+class RetentionPolicy(object):
+    """rules deciding which tags to delete registry-wide, loaded from a JSON file like:
+
+    {"rules": [
+        {"repositories": "library/.*", "protect": "^(latest|stable)$", "keep_newest": 5},
+        {"keep_newest": 10, "older_than_days": 90, "untagged": true}
+    ]}
+
+    The first rule whose "repositories" regex matches the whole repository name
+    applies to it. Tags matching "protect" are never deleted and do not count
+    towards "keep_newest". Of the rest, the newest "keep_newest" tags are kept,
+    and only tags whose current/link is older than "older_than_days" are
+    deleted. With "untagged", untagged data is deleted from the repository too.
+    """
+
+    def __init__(self, rules):
+        self.rules = [RetentionRule(rule) for rule in rules]
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "r") as policy:
+                data = json.load(policy)
+        except (IOError, ValueError) as error:
+            raise RegistryCleanerError("Failed to load retention policy {0}: {1}".format(path, error))
+        if not isinstance(data, dict):
+            raise RegistryCleanerError("Retention policy {0} must be a JSON object with a "
+                                       "\"rules\" list".format(path))
+        rules = data.get("rules", [])
+        if not isinstance(rules, list):
+            raise RegistryCleanerError("Retention policy {0}: \"rules\" must be a list".format(path))
+        return cls(rules)
+
+    def rule_for(self, repo):
+        for rule in self.rules:
+            if rule.matches(repo):
+                return rule
+        return None
+
+
 class RegistryCleaner(object):
     """Clean registry"""
 
-    def __init__(self, registry_data_dir, dry_run=False):
+    def __init__(self, registry_data_dir, dry_run=False, index_file=None, rebuild_index=False,
+                 jobs=1, plan_file=None, journal_file=None, deadline=None):
         self.registry_data_dir = registry_data_dir
         if not os.path.isdir(self.registry_data_dir):
             raise RegistryCleanerError("No repositories directory found inside " \
                                        "REGISTRY_DATA_DIR '{0}'.".
                                        format(self.registry_data_dir))
         self.dry_run = dry_run
+        self.jobs = jobs
+        self.plan_file = plan_file
+        self.deadline = deadline
+        self.interrupted = False
+        self.errors = []
+        self.deleted = []
+        self._graph = None
+        self._tag_indexes = {}
+        self._manifest_layers = {}
+        self._plan = None
+        self._index = None
+        self._journal = DeletionJournal(journal_file) if journal_file else None
+        if index_file:
+            self._index = LinkIndex(index_file, rebuild=rebuild_index)
 
     def _delete_layer(self, repo, digest):
         """remove blob directory from filesystem"""
+        if not self._check_digest(digest, "layer link of " + repo):
+            return
         path = os.path.join(self.registry_data_dir, "repositories", repo, "_layers/sha256", digest)
         self._delete_dir(path)
+        self._get_graph().remove_layer(repo, digest)
 
     def _delete_blob(self, digest):
         """remove blob directory from filesystem"""
+        if not self._check_digest(digest, "blob"):
+            return
         path = os.path.join(self.registry_data_dir, "blobs/sha256", digest[0:2], digest)
         self._delete_dir(path)
+        if self._index is not None and not self.dry_run:
+            self._index.forget_blob(digest)
+
+    def _check_digest(self, digest, what):
+        """refuse to delete anything for a digest that is not one, like the "" of a broken link"""
+        if is_digest(digest):
+            return True
+        logger.critical("Not deleting %s for invalid digest %r, a link is probably broken", what, digest)
+        return False
 
     def _blob_path_for_revision(self, digest):
         """where we can find the blob that contains the json describing this digest"""
         return os.path.join(self.registry_data_dir, "blobs/sha256",
                             digest[0:2], digest, "data")
 
-    def _blob_path_for_revision_is_missing(self, digest):
-        """for each revision, there should be a blob describing it"""
-        return not os.path.isfile(self._blob_path_for_revision(digest))
-
     def _get_layers_from_blob(self, digest):
-        """get layers from blob by digest"""
-        return get_layers_from_blob(self._blob_path_for_revision(digest))
+        """get layers from blob by digest, parsing each manifest at most once per run"""
+        if digest not in self._manifest_layers:
+            path = self._blob_path_for_revision(digest)
+            with metrics.phase("manifests"):
+                if self._index is not None:
+                    layers = self._index.manifest_layers(digest, path)
+                else:
+                    layers = get_layers_from_blob(path)
+            self._manifest_layers[digest] = frozenset(layers)
+        return self._manifest_layers[digest]
 
     def _delete_dir(self, path):
+        """remove directory from filesystem, or queue it if a batch is open"""
+        if self._plan is not None:
+            self._plan.add(path)
+        else:
+            self._remove_dir(path)
+
+    @contextmanager
+    def batch(self):
+        """queue every deletion made inside the block and run them all when it ends
+
+        Deletions decided inside the block are applied to the reference graph
+        right away, so later targets see what earlier targets released.
+        """
+        if self._plan is not None:
+            yield self._plan
+            return
+        self._plan = plan = DeletionPlan()
+        try:
+            with metrics.phase("plan"):
+                yield plan
+        finally:
+            self._plan = None
+        self._execute_plan(plan)
+
+    def _start_target(self, repo, tag, action):
+        if self._plan is not None:
+            self._plan.start_target(repo, tag, action)
+
+    def _keep(self, digest, reason):
+        if self._plan is not None:
+            self._plan.keep(digest, reason)
+
+    def _blob_size(self, path):
+        try:
+            return os.stat(os.path.join(path, "data")).st_size
+        except OSError:
+            return 0
+
+    def plan_report(self, plan):
+        """describe a plan: per image, the blobs it frees with their sizes and the shared blobs it keeps"""
+        blobs_dir = os.path.join(self.registry_data_dir, "blobs") + os.sep
+        sizes = dict(ordered_map(self._blob_size,
+                                 [path for path in plan.paths if path.startswith(blobs_dir)],
+                                 self.jobs))
+        targets = []
+        for target in plan.targets:
+            freed = [{"digest": os.path.basename(path), "bytes": sizes[path]}
+                     for path in target["deleted"] if path in sizes]
+            targets.append({
+                "repository": target["repository"],
+                "tag": target["tag"],
+                "action": target["action"],
+                "freed_blobs": freed,
+                "kept_blobs": [{"digest": digest, "reason": reason}
+                               for digest, reason in sorted(target["kept"].items())],
+                "deletions": len(target["deleted"]),
+                "bytes": sum(blob["bytes"] for blob in freed),
+            })
+        return {
+            "registry_data_dir": self.registry_data_dir,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "dry_run": self.dry_run,
+            "targets": targets,
+            "deletions": plan.paths,
+            "blobs": len(sizes),
+            "bytes": sum(sizes.values()),
+        }
+
+    def write_plan(self, plan, path):
+        """write plan_report() of plan as JSON, '-' for stdout"""
+        report = self.plan_report(plan)
+        logger.info("Plan: %d deletions, %d blobs, %d bytes reclaimable",
+                    len(plan), report["blobs"], report["bytes"])
+        if path == "-":
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(path, "w") as plan_file:
+                json.dump(report, plan_file, indent=2)
+        return report
+
+    def execute_plan_file(self, path):
+        """delete what a plan written by write_plan lists, without scanning the registry"""
+        with open(path, "r") as plan_file:
+            report = json.load(plan_file)
+        if os.path.normpath(report["registry_data_dir"]) != os.path.normpath(self.registry_data_dir):
+            raise RegistryCleanerError("Plan {0} was made for {1}, not {2}".format(
+                path, report["registry_data_dir"], self.registry_data_dir))
+        self._check_plan_paths(report["deletions"], "Plan {0}".format(path))
+        logger.info("Executing plan %s from %s: %d deletions, %d bytes",
+                    path, report["created"], len(report["deletions"]), report["bytes"])
+        self._execute_plan(DeletionPlan(report["deletions"]))
+
+    def _check_plan_paths(self, paths, source):
+        """refuse a plan or journal that would delete anything outside repositories/ and blobs/"""
+        roots = [os.path.join(os.path.abspath(self.registry_data_dir), name) + os.sep
+                 for name in ("repositories", "blobs")]
+        outside = [path for path in paths
+                   if not any(os.path.abspath(path).startswith(root) for root in roots)]
+        if outside:
+            raise RegistryCleanerError("{0} lists {1} deletions outside {2}/repositories and "
+                                       "{2}/blobs, such as {3}".format(
+                                           source, len(outside), self.registry_data_dir, outside[0]))
+
+    def has_pending_journal(self):
+        return self._journal is not None and self._journal.pending() is not None
+
+    def resume_journal(self):
+        """finish the journal's unfinished plan without scanning the registry, False if there is none"""
+        pending = self._journal.pending()
+        if pending is None:
+            logger.info("Journal %s has no unfinished plan", self._journal.path)
+            return False
+        entry, done = pending
+        if os.path.normpath(entry["registry_data_dir"]) != os.path.normpath(self.registry_data_dir):
+            raise RegistryCleanerError("Journal {0} was made for {1}, not {2}".format(
+                self._journal.path, entry["registry_data_dir"], self.registry_data_dir))
+        self._check_plan_paths(entry["deletions"], "Journal {0}".format(self._journal.path))
+        # a deletion can finish without its done line being written, so anything
+        # already gone counts as done
+        left = [path for path in entry["deletions"] if path not in done and os.path.lexists(path)]
+        left_set = set(left)
+        self.deleted.extend(path for path in entry["deletions"] if path not in left_set)
+        metrics.count("journal_skipped", len(entry["deletions"]) - len(left))
+        logger.info("Resuming plan from %s of journal %s: %d of %d deletions left",
+                    entry["created"], self._journal.path, len(left), len(entry["deletions"]))
+        self._execute_plan(DeletionPlan(left), resume=True)
+        return True
+
+    def _until_deadline(self, paths):
+        """paths, until self.deadline passes"""
+        for path in paths:
+            if self.deadline is not None and time.time() >= self.deadline:
+                return
+            yield path
+
+    def _execute_plan(self, plan, resume=False):
+        """delete queued directories phase by phase, each phase on a pool of self.jobs threads
+
+        With a journal, the plan and every deletion are recorded as they
+        happen, and with a deadline no deletion starts after it passes. A
+        phase with failed deletions stops the plan, so no blob is deleted
+        while a tag or link that may still point at it is left behind.
+        """
+        with metrics.phase("report"):
+            if self.plan_file:
+                self.write_plan(plan, self.plan_file)
+            elif self.dry_run:
+                report = self.plan_report(plan)
+                logger.info("DRY_RUN: plan has %d deletions, %d blobs, %d bytes reclaimable",
+                            len(plan), report["blobs"], report["bytes"])
+        logger.debug("Executing plan of %d deletions with %d jobs", len(plan), self.jobs)
+        failed = len(self.errors)
+        phases = plan.phases(self.registry_data_dir)
+        journal = self._journal if not self.dry_run and (plan or resume) else None
+        if journal is not None and not resume:
+            journal.start(self.registry_data_dir, [path for paths in phases for path in paths])
+        left = sum(len(paths) for paths in phases)
+        stopped = False
+        for phase, paths in enumerate(phases):
+            if not paths:
+                continue
+            logger.debug("Deleting %d %s", len(paths), PHASE_NAMES[phase])
+            with metrics.phase("delete"):
+                if self.dry_run:
+                    for path in paths:
+                        self._remove_dir(path)
+                    left -= len(paths)
+                    continue
+                remove = self._remove_blob if phase == PHASE_BLOBS else remove_tree
+                for path, error in ordered_map(remove, self._until_deadline(paths), self.jobs):
+                    self._log_removal(path, error)
+                    if journal is not None:
+                        journal.record(path, error)
+                    left -= 1
+            if journal is not None:
+                journal.sync()
+            if left and len(self.errors) > failed:
+                stopped = True
+                logger.critical("Not deleting the %d directories left since %s failed to delete",
+                                left, PHASE_NAMES[phase])
+                break
+            if left and self.deadline is not None and time.time() >= self.deadline:
+                break
+        if len(self.errors) > failed:
+            logger.critical("Failed to delete %d directories%s", len(self.errors) - failed,
+                            ", retry them with --resume --journal {0}".format(journal.path)
+                            if journal is not None else "")
+        if left and not stopped:
+            self.interrupted = True
+            logger.warning("Time limit reached with %d deletions left%s", left,
+                           ", resume them with --resume --journal {0}".format(journal.path)
+                           if journal is not None else "")
+        if not left and len(self.errors) == failed and journal is not None:
+            # a plan with failed deletions stays open, so --resume can retry them
+            journal.finish()
+
+    def _remove_dir(self, path):
         """remove directory from filesystem"""
         if self.dry_run:
             logger.info("DRY_RUN: would have deleted %s", path)
+            self.deleted.append(path)
         else:
-            logger.info("Deleting %s", path)
-            try:
-                shutil.rmtree(path)
-            except Exception as error:
-                logger.critical("Failed to delete directory:%s", error)
+            self._log_removal(path, remove_tree(path))
+
+    def _remove_blob(self, path):
+        """remove_tree for a blob directory, counting the bytes of its data"""
+        size = self._blob_size(path)
+        error = remove_tree(path)
+        if error is None:
+            metrics.count("bytes_deleted", size)
+        return error
+
+    def _log_removal(self, path, error):
+        logger.info("Deleting %s", path)
+        if error is not None:
+            logger.critical("Failed to delete directory:%s", error)
+            self.errors.append((path, error))
+        else:
+            metrics.count("dirs_deleted")
+            self.deleted.append(path)
+
+    def _get_graph(self):
+        """scan the registry once and keep the reference graph for the rest of the run"""
+        if self._graph is None:
+            logger.debug("Building reference graph of %s", self.registry_data_dir)
+            with metrics.phase("scan"):
+                self._graph = ReferenceGraph()
+                root = os.path.join(self.registry_data_dir, "repositories")
+                scan = lambda repo: scan_repository(os.path.join(root, repo), self._read_link)
+                for repo, refs in ordered_map(scan, self._get_repositories(), self.jobs):
+                    metrics.count("repositories_scanned")
+                    self._graph.add_repository(repo, refs)
+                if self._index is not None:
+                    self._index.forget_unseen()
+        return self._graph
+
+    def _read_link(self, path):
+        """read a link file, through the index if there is one"""
+        if self._index is not None:
+            return self._index.read_link(path)
+        return read_link(path)
+
+    def _get_repo_refs(self, repo):
+        """get the links of one repository from the reference graph, None if there is no such repository"""
+        graph = self._get_graph()
+        if repo not in graph.repos:
+            path = os.path.join(self.registry_data_dir, "repositories", repo)
+            if repo in graph.removed or not os.path.isdir(path):
+                return None
+            graph.add_repository(repo, scan_repository(path, self._read_link))
+        return graph.repos[repo]
+
+    def _scan_repo_refs(self, repo):
+        """like _get_repo_refs, but scans only repo when the reference graph is not built yet"""
+        if self._graph is not None:
+            return self._get_repo_refs(repo)
+        path = os.path.join(self.registry_data_dir, "repositories", repo)
+        if not os.path.isdir(path):
+            return None
+        with metrics.phase("scan"):
+            metrics.count("repositories_scanned")
+            return scan_repository(path, self._read_link)
+
+    def close(self):
+        """save the index and close the journal, if there are any"""
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        if self._journal is not None:
+            self._journal.close()
 
     def _delete_from_tag_index_for_revision(self, repo, digest):
         """delete revision from tag indexes"""
-        paths = glob.glob(
-            os.path.join(self.registry_data_dir, "repositories", repo,
-                         "_manifests/tags/*/index/sha256", digest)
-        )
-        for path in paths:
-            self._delete_dir(path)
+        graph = self._get_graph()
+        for tag, digests in list(self._get_repo_refs(repo).tag_indexes.items()):
+            if digest in digests:
+                self._delete_dir(os.path.join(self.registry_data_dir, "repositories", repo,
+                                              "_manifests/tags", tag, "index/sha256", digest))
+                graph.remove_tag_index(repo, tag, digest)
 
     def _delete_revisions(self, repo, revisions, blobs_to_keep=None):
-        """delete revisions from list of directories"""
+        """delete revisions by manifest digest"""
         if blobs_to_keep is None:
             blobs_to_keep = []
-        for revision_dir in revisions:
-            digests = get_links(revision_dir)
-            for digest in digests:
-                self._delete_from_tag_index_for_revision(repo, digest)
-                if digest not in blobs_to_keep:
-                    self._delete_blob(digest)
-
-            self._delete_dir(revision_dir)
+        graph = self._get_graph()
+        for digest in revisions:
+            if not self._check_digest(digest, "revision of " + repo):
+                continue
+            self._delete_from_tag_index_for_revision(repo, digest)
+            if digest not in blobs_to_keep:
+                self._delete_blob(digest)
 
-    def _get_tags(self, repo):
-        """get all tags for given repository"""
-        path = os.path.join(self.registry_data_dir, "repositories", repo, "_manifests/tags")
-        if not os.path.isdir(path):
-            logger.critical("No repository '%s' found in repositories directory %s",
-                             repo, self.registry_data_dir)
-            return None
-        result = []
-        for each in os.listdir(path):
-            filepath = os.path.join(path, each)
-            if os.path.isdir(filepath):
-                result.append(each)
-        return result
+            self._delete_dir(os.path.join(self.registry_data_dir, "repositories", repo,
+                                          "_manifests/revisions/sha256", digest))
+            graph.remove_revision(repo, digest)
 
     def _get_repositories(self):
         """get all repository repos"""
         result = []
         root = os.path.join(self.registry_data_dir, "repositories")
-        for each in os.listdir(root):
-            filepath = os.path.join(root, each)
-            if os.path.isdir(filepath):
-                inside = os.listdir(filepath)
-                if "_layers" in inside:
-                    result.append(each)
-                else:
-                    for inner in inside:
-                        result.append(os.path.join(each, inner))
+        for each in list_dirs(root):
+            inside = os.listdir(os.path.join(root, each))
+            metrics.count("dirs_listed")
+            if "_layers" in inside:
+                result.append(each)
+            else:
+                for inner in inside:
+                    result.append(os.path.join(each, inner))
         return result
 
-    def _get_all_links(self, except_repo=""):
-        """get links for every repository"""
-        result = []
-        repositories = self._get_repositories()
-        for repo in [r for r in repositories if r != except_repo]:
-            path = os.path.join(self.registry_data_dir, "repositories", repo)
-            for link in get_links(path):
-                result.append(link)
-        return result
+    def prune(self, full=False):
+        """delete the directories this run left empty, or with full all empty directories in registry_data_dir"""
+        with metrics.phase("prune"):
+            if full:
+                del_empty_dirs(self.registry_data_dir, True)
+            else:
+                del_empty_parents(self.deleted, self.registry_data_dir, self.dry_run)
 
-    def prune(self):
-        """delete all empty directories in registry_data_dir"""
-        del_empty_dirs(self.registry_data_dir, True)
+    def _get_tag_index(self, repo):
+        """map every manifest and layer of repo to the tags using it, built once per repository"""
+        if repo not in self._tag_indexes:
+            index = TagIndex()
+            for tag, manifest in self._get_repo_refs(repo).tags.items():
+                # a missing or broken manifest blob was already logged and has no layers
+                index.add_tag(tag, manifest, self._get_layers_from_blob(manifest))
+            self._tag_indexes[repo] = index
+        return self._tag_indexes[repo]
+
+    def _forget_tag(self, repo, tag):
+        """drop a deleted tag from the reference graph and the tag index"""
+        self._get_graph().remove_tag(repo, tag)
+        if repo in self._tag_indexes:
+            self._tag_indexes[repo].remove_tag(tag)
 
     def _layer_in_same_repo(self, repo, tag, layer):
         """check if layer is found in other tags of same repository"""
-        for other_tag in [t for t in self._get_tags(repo) if t != tag]:
-            path = os.path.join(self.registry_data_dir, "repositories", repo,
-                                "_manifests/tags", other_tag, "current/link")
-            manifest = get_digest_from_blob(path)
-            try:
-                layers = self._get_layers_from_blob(manifest)
-                if layer in layers:
-                    return True
-            except IOError:
-                if self._blob_path_for_revision_is_missing(manifest):
-                    logger.warn("Blob for digest %s does not exist. Deleting tag manifest: %s", manifest, other_tag)
-                    tag_dir = os.path.join(self.registry_data_dir, "repositories", repo,
-                                           "_manifests/tags", other_tag)
-                    self._delete_dir(tag_dir)
-                else:
-                    raise
-        return False
+        return self._get_tag_index(repo).layer_in_other_tag(layer, tag)
 
     def _manifest_in_same_repo(self, repo, tag, manifest):
         """check if manifest is found in other tags of same repository"""
-        for other_tag in [t for t in self._get_tags(repo) if t != tag]:
-            path = os.path.join(self.registry_data_dir, "repositories", repo,
-                                "_manifests/tags", other_tag, "current/link")
-            other_manifest = get_digest_from_blob(path)
-            if other_manifest == manifest:
-                return True
-
-        return False
+        return self._get_tag_index(repo).manifest_in_other_tag(manifest, tag)
 
+    @batched
     def delete_entire_repository(self, repo):
         """delete all blobs for given repository repo"""
         logger.debug("Deleting entire repository '%s'", repo)
         repo_dir = os.path.join(self.registry_data_dir, "repositories", repo)
-        if not os.path.isdir(repo_dir):
+        refs = self._get_repo_refs(repo)
+        if refs is None:
             raise RegistryCleanerError("No repository '{0}' found in repositories "
                                        "directory {1}/repositories".
                                        format(repo, self.registry_data_dir))
-        links = set(get_links(repo_dir))
-        all_links_but_current = set(self._get_all_links(except_repo=repo))
+        self._start_target(repo, None, "repository")
+        graph = self._get_graph()
+        links = refs.links()
         for layer in links:
-            if layer in all_links_but_current:
+            if graph.linked_elsewhere(layer, repo):
                 logger.debug("Blob found in another repository. Not deleting: %s", layer)
+                self._keep(layer, "used by another repository")
             else:
                 self._delete_blob(layer)
         self._delete_dir(repo_dir)
+        graph.remove_repository(repo)
+        self._tag_indexes.pop(repo, None)
 
+    @batched
     def delete_repository_tag(self, repo, tag):
         """delete all blobs only for given tag of repository"""
         logger.debug("Deleting repository '%s' with tag '%s'", repo, tag)
         tag_dir = os.path.join(self.registry_data_dir, "repositories", repo, "_manifests/tags", tag)
-        if not os.path.isdir(tag_dir):
+        refs = self._get_repo_refs(repo)
+        if refs is None or (tag not in refs.tag_indexes and not os.path.isdir(tag_dir)):
             raise RegistryCleanerError("No repository '{0}' tag '{1}' found in repositories "
                                        "directory {2}/repositories".
                                        format(repo, tag, self.registry_data_dir))
-        manifests_for_tag = set(get_links(tag_dir))
+        self._start_target(repo, tag, "tag")
+        graph = self._get_graph()
+        manifests_for_tag = refs.tag_links(tag)
         revisions_to_delete = []
         blobs_to_keep = []
         layers = []
-        all_links_not_in_current_repo = set(self._get_all_links(except_repo=repo))
         for manifest in manifests_for_tag:
             logger.debug("Looking up filesystem layers for manifest digest %s", manifest)
 
             if self._manifest_in_same_repo(repo, tag, manifest):
                 logger.debug("Not deleting since we found another tag using manifest: %s", manifest)
+                self._keep(manifest, "used by another tag")
                 continue
             else:
-                revisions_to_delete.append(
-                    os.path.join(self.registry_data_dir, "repositories", repo,
-                                 "_manifests/revisions/sha256", manifest)
-                )
-                if manifest in all_links_not_in_current_repo:
+                revisions_to_delete.append(manifest)
+                if graph.linked_elsewhere(manifest, repo):
                     logger.debug("Not deleting the blob data since we found another repo using manifest: %s", manifest)
+                    self._keep(manifest, "used by another repository")
                     blobs_to_keep.append(manifest)
 
                 layers.extend(self._get_layers_from_blob(manifest))
@@ -277,27 +1270,31 @@ class RegistryCleaner(object):
         for layer in layers_uniq:
             if self._layer_in_same_repo(repo, tag, layer):
                 logger.debug("Not deleting since we found another tag using digest: %s", layer)
+                self._keep(layer, "used by another tag")
                 continue
 
             self._delete_layer(repo, layer)
-            if layer in all_links_not_in_current_repo:
+            if graph.linked_elsewhere(layer, repo):
                 logger.debug("Blob found in another repository. Not deleting: %s", layer)
+                self._keep(layer, "used by another repository")
             else:
                 self._delete_blob(layer)
 
         self._delete_revisions(repo, revisions_to_delete, blobs_to_keep)
         self._delete_dir(tag_dir)
+        self._forget_tag(repo, tag)
 
+    @batched
     def delete_untagged(self, repo):
         """delete all untagged data from repo"""
         logger.debug("Deleting utagged data from repository '%s'", repo)
-        repositories_dir = os.path.join(self.registry_data_dir, "repositories")
-        repo_dir = os.path.join(repositories_dir, repo)
-        if not os.path.isdir(repo_dir):
+        refs = self._get_repo_refs(repo)
+        if refs is None:
             raise RegistryCleanerError("No repository '{0}' found in repositories "
                                        "directory {1}/repositories".
                                        format(repo, self.registry_data_dir))
-        tagged_links = set(get_links(repositories_dir, _filter="current"))
+        self._start_target(repo, None, "untagged")
+        tagged_links = self._get_graph().tagged_manifests()
         layers_to_protect = []
         for link in tagged_links:
             layers_to_protect.extend(self._get_layers_from_blob(link))
@@ -306,18 +1303,19 @@ class RegistryCleaner(object):
         for layer in unique_layers_to_protect:
             logger.debug("layer_to_protect: %s", layer)
 
-        tagged_revisions = set(get_links(repo_dir, _filter="current"))
+        tagged_revisions = set(refs.tags.values())
 
         revisions_to_delete = []
         layers_to_delete = []
 
-        dir_for_revisions = os.path.join(repo_dir, "_manifests/revisions/sha256")
-        for rev in os.listdir(dir_for_revisions):
+        for rev in sorted(refs.revisions):
             if rev not in tagged_revisions:
-                revisions_to_delete.append(os.path.join(dir_for_revisions, rev))
+                revisions_to_delete.append(rev)
                 for layer in self._get_layers_from_blob(rev):
                     if layer not in unique_layers_to_protect:
                         layers_to_delete.append(layer)
+                    else:
+                        self._keep(layer, "used by a tagged manifest")
 
         unique_layers_to_delete = set(layers_to_delete)
 
@@ -327,25 +1325,208 @@ class RegistryCleaner(object):
             self._delete_layer(repo, layer)
 
 
+    def _list_blobs(self):
+        """digests of every directory under blobs/sha256"""
+        root = os.path.join(self.registry_data_dir, "blobs", "sha256")
+        for prefix in sorted(list_dirs(root)):
+            for digest in sorted(list_dirs(os.path.join(root, prefix))):
+                yield digest
+
+    def verify(self, repos=None, state_file=None):
+        """re-hash blobs and check that links and blobs match up
+
+        Every blob's data is hashed on a pool of self.jobs processes and
+        compared with its digest. Links to blobs that do not exist are reported,
+        and without repos so are blobs that no link references. With repos,
+        only the blobs those repositories link to are checked. Digests already
+        listed in state_file are skipped, and every result is appended to it,
+        so an interrupted verify can be resumed.
+        """
+        if repos:
+            # only the given repositories are scanned, so the run stays bounded on large registries
+            holders = {}
+            for repo in repos:
+                refs = self._scan_repo_refs(repo)
+                if refs is None:
+                    raise RegistryCleanerError("No repository '{0}' found in repositories "
+                                               "directory {1}/repositories".
+                                               format(repo, self.registry_data_dir))
+                for digest in refs.links():
+                    holders.setdefault(digest, set()).add(repo)
+            holders.pop("", None)
+            referenced = set(holders)
+            blobs = sorted(d for d in referenced
+                           if os.path.isdir(os.path.dirname(self._blob_path_for_revision(d))))
+        else:
+            holders = self._get_graph().refcounts
+            referenced = set(d for d in holders if d)
+            blobs = list(self._list_blobs())
+
+        existing = set(blobs)
+        report = {
+            "checked": 0,
+            "skipped": 0,
+            "corrupt": [],
+            "unreadable": [],
+            "missing": dict((d, sorted(holders.get(d, ())))
+                            for d in sorted(referenced - existing)),
+            "unreferenced": [] if repos else sorted(existing - referenced),
+        }
+        for digest, holders in sorted(report["missing"].items()):
+            logger.error("Blob %s is missing, linked from %s", digest, ", ".join(holders))
+        for digest in report["unreferenced"]:
+            logger.warning("Blob %s is not referenced by any link", digest)
+
+        done = {}
+        if state_file and os.path.exists(state_file):
+            with open(state_file, "r") as state:
+                for line in state:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        done[fields[0]] = fields[1]
+        todo = [d for d in blobs if d not in done]
+        report["skipped"] = len(blobs) - len(todo)
+        for digest in blobs:
+            if done.get(digest) in ("corrupt", "unreadable"):
+                report[done[digest]].append(digest)
+
+        state = open(state_file, "a") if state_file else None
+        try:
+            logger.info("Verifying %d blobs (%d already verified) with %d jobs",
+                        len(todo), report["skipped"], self.jobs)
+            paths = [self._blob_path_for_revision(d) for d in todo]
+            with metrics.phase("verify"):
+                for path, actual in ordered_map(hash_blob, paths, self.jobs, ProcessPoolExecutor):
+                    digest = os.path.basename(os.path.dirname(path))
+                    metrics.count("blobs_hashed")
+                    if actual is None:
+                        status = "unreadable"
+                        logger.error("Blob %s cannot be read", digest)
+                    else:
+                        # hashed in a worker process, so counted here
+                        metrics.count("files_opened")
+                        if actual != digest:
+                            status = "corrupt"
+                            logger.error("Blob %s is corrupt, its data hashes to %s", digest, actual)
+                        else:
+                            status = "ok"
+                    report["checked"] += 1
+                    if status != "ok":
+                        report[status].append(digest)
+                    if state is not None:
+                        state.write("{0} {1}\n".format(digest, status))
+                        state.flush()
+        finally:
+            if state is not None:
+                state.close()
+        logger.info("Verified %d blobs: %d corrupt, %d unreadable, %d missing, %d unreferenced",
+                    report["checked"] + report["skipped"], len(report["corrupt"]),
+                    len(report["unreadable"]), len(report["missing"]), len(report["unreferenced"]))
+        return report
+
+    def _get_tag_mtimes(self, repo):
+        """{tag: mtime of its current/link} for every tag of repo"""
+        result = {}
+        tags_dir = os.path.join(self.registry_data_dir, "repositories", repo, "_manifests/tags")
+        for tag in self._get_repo_refs(repo).tag_indexes:
+            try:
+                result[tag] = os.stat(os.path.join(tags_dir, tag, "current/link")).st_mtime
+            except OSError:
+                logger.warning("Tag %s:%s has no current link, skipping it", repo, tag)
+        return result
+
+    @batched
+    def apply_policy(self, policy, now=None):
+        """delete the tags a RetentionPolicy expires, and untagged data where it asks for it"""
+        if now is None:
+            now = time.time()
+        for repo in sorted(self._get_repositories()):
+            rule = policy.rule_for(repo)
+            if rule is None or self._get_repo_refs(repo) is None:
+                continue
+            for tag in rule.expired_tags(self._get_tag_mtimes(repo), now):
+                logger.info("Retention policy expires %s:%s", repo, tag)
+                self.delete_repository_tag(repo, tag)
+            if rule.untagged:
+                self.delete_untagged(repo)
+
     def get_tag_count(self, repo):
         logger.debug("Get tag count of repository '%s'", repo)
         repo_dir = os.path.join(self.registry_data_dir, "repositories", repo)
         tags_dir = os.path.join(repo_dir, "_manifests/tags")
 
-        if os.path.isdir(tags_dir):
-            tags = os.listdir(tags_dir)
-            return len(tags)
+        refs = self._get_repo_refs(repo)
+        if refs is not None and os.path.isdir(tags_dir):
+            return len(refs.tag_indexes)
         else:
             logger.info("Tags directory does not exist: '%s'", tags_dir)
             return -1
 
+def parse_image(image):
+    """split image[:tag] into (image, tag)"""
+    splitted = image.split(":")
+    if len(splitted) == 2:
+        return splitted[0], splitted[1]
+    return image, None
+
+
+def read_targets(path):
+    """read image[:tag] targets, one per line, from a file or '-' for stdin"""
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r") as targets:
+            lines = targets.read().splitlines()
+    return [parse_image(line.strip()) for line in lines
+            if line.strip() and not line.strip().startswith("#")]
+
+
+def clean_image(cleaner, image, tag, untagged=False):
+    """delete one image, one tag of it, or its untagged data"""
+    if untagged:
+        cleaner.delete_untagged(image)
+    else:
+        if tag:
+            tag_count = cleaner.get_tag_count(image)
+            if tag_count == 1:
+                cleaner.delete_entire_repository(image)
+            else:
+                cleaner.delete_repository_tag(image, tag)
+        else:
+            cleaner.delete_entire_repository(image)
+
+
 def main():
     """cli entrypoint"""
     parser = argparse.ArgumentParser(description="Cleanup docker registry")
-    parser.add_argument("-i", "--image",
-                        dest="image",
-                        required=True,
-                        help="Docker image to cleanup")
+    targets = parser.add_mutually_exclusive_group(required=True)
+    targets.add_argument("-i", "--image",
+                         dest="image",
+                         help="Docker image to cleanup")
+    targets.add_argument("-b", "--batch",
+                         dest="batch",
+                         help="File with one image[:tag] to cleanup per line, or '-' for stdin. "
+                              "All images are planned against one view of the registry and "
+                              "deleted together")
+    targets.add_argument("--policy",
+                         dest="policy",
+                         help="JSON retention policy to apply to every repository in one scan, "
+                              "see RetentionPolicy for the format")
+    targets.add_argument("--verify",
+                         dest="verify",
+                         action="store_true",
+                         help="Re-hash blobs on --jobs processes and report corrupt or missing "
+                              "blobs, and blobs no link references")
+    targets.add_argument("--execute-plan",
+                         dest="execute_plan",
+                         help="Delete what a plan written with --plan-file lists, without "
+                              "scanning the registry again. Keep the registry shut down "
+                              "between writing and executing the plan")
+    targets.add_argument("--resume",
+                         dest="resume",
+                         action="store_true",
+                         help="Finish the unfinished plan of --journal, without scanning the "
+                              "registry again")
     parser.add_argument("-v", "--verbose",
                         dest="verbose",
                         action="store_true",
@@ -361,11 +1542,57 @@ def main():
     parser.add_argument("-p", "--prune",
                         dest="prune",
                         action="store_true",
-                        help="Prune")
+                        help="Prune the directories this run left empty")
+    parser.add_argument("--prune-all",
+                        dest="prune_all",
+                        action="store_true",
+                        help="Prune every empty directory in the registry (walks the whole tree)")
     parser.add_argument("-u", "--untagged",
                         dest="untagged",
                         action="store_true",
                         help="Delete all untagged blobs for image")
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs",
+                        type=int,
+                        default=1,
+                        help="Number of threads scanning repositories and deleting "
+                             "directories (default: 1)")
+    parser.add_argument("--plan-file",
+                        dest="plan_file",
+                        help="Write the deletion plan as JSON to this file ('-' for stdout): "
+                             "per image, the blobs freed and their sizes, the shared blobs "
+                             "kept, and the total bytes reclaimable")
+    parser.add_argument("--verify-repo",
+                        dest="verify_repos",
+                        action="append",
+                        help="Only verify the blobs this repository links to (can be repeated)")
+    parser.add_argument("--verify-state",
+                        dest="verify_state",
+                        help="File recording verified blobs, so an interrupted --verify resumes "
+                             "where it stopped")
+    parser.add_argument("--index-file",
+                        dest="index_file",
+                        default=os.environ.get("REGISTRY_INDEX_FILE"),
+                        help="SQLite file caching links and manifest layers between runs, "
+                             "so only changed files are re-read (default: $REGISTRY_INDEX_FILE)")
+    parser.add_argument("--rebuild-index",
+                        dest="rebuild_index",
+                        action="store_true",
+                        help="Throw away the index file and build it from scratch")
+    parser.add_argument("--journal",
+                        dest="journal",
+                        help="Append the deletion plan and every completed deletion to this "
+                             "file, so an interrupted run can be finished with --resume")
+    parser.add_argument("--time-limit",
+                        dest="time_limit",
+                        type=float,
+                        help="Stop starting deletions after this many seconds and exit with "
+                             "status 3, leaving the rest of the plan in --journal")
+    parser.add_argument("--metrics-file",
+                        dest="metrics_file",
+                        help="Write phase timings and I/O counters (directories listed, files "
+                             "opened, manifests parsed, bytes deleted) as JSON to this file "
+                             "when the run ends ('-' for stderr)")
     args = parser.parse_args()
 
 
@@ -384,38 +1611,72 @@ def main():
         logger.info(
             "You supplied the force switch, which is deprecated. It has no effect now, and the script defaults to doing what used to be only happen when force was true")
 
-    splitted = args.image.split(":")
-    if len(splitted) == 2:
-        image = splitted[0]
-        tag = splitted[1]
+    if (args.resume or args.time_limit is not None) and not args.journal:
+        parser.error("--resume and --time-limit need --journal")
+
+    if args.batch:
+        targets = read_targets(args.batch)
+    elif args.image:
+        targets = [parse_image(args.image)]
     else:
-        image = args.image
-        tag = None
+        targets = []
 
     if 'REGISTRY_DATA_DIR' in os.environ:
         registry_data_dir = os.environ['REGISTRY_DATA_DIR']
     else:
         registry_data_dir = "/opt/registry_data/docker/registry/v2"
 
+    cleaner = None
+    failed = False
     try:
-        cleaner = RegistryCleaner(registry_data_dir, dry_run=args.dry_run)
-        if args.untagged:
-            cleaner.delete_untagged(image)
+        cleaner = RegistryCleaner(registry_data_dir, dry_run=args.dry_run,
+                                  index_file=args.index_file,
+                                  rebuild_index=args.rebuild_index,
+                                  jobs=args.jobs,
+                                  plan_file=args.plan_file,
+                                  journal_file=args.journal,
+                                  deadline=None if args.time_limit is None
+                                  else time.time() + args.time_limit)
+        if not args.resume and not args.verify and cleaner.has_pending_journal():
+            raise RegistryCleanerError("Journal {0} has an unfinished plan, finish it with "
+                                       "--resume first".format(args.journal))
+        if args.verify:
+            report = cleaner.verify(args.verify_repos, args.verify_state)
+            if report["corrupt"] or report["unreadable"] or report["missing"]:
+                failed = True
+        elif args.execute_plan:
+            cleaner.execute_plan_file(args.execute_plan)
+        elif args.resume:
+            cleaner.resume_journal()
+        elif args.policy:
+            cleaner.apply_policy(RetentionPolicy.load(args.policy))
         else:
-            if tag:
-                tag_count = cleaner.get_tag_count(image)
-                if tag_count == 1:
-                    cleaner.delete_entire_repository(image)
-                else:
-                    cleaner.delete_repository_tag(image, tag)
-            else:
-                cleaner.delete_entire_repository(image)
+            with cleaner.batch():
+                for image, tag in targets:
+                    try:
+                        clean_image(cleaner, image, tag, args.untagged)
+                    except RegistryCleanerError as error:
+                        if not args.batch:
+                            raise
+                        logger.error(error)
+                        failed = True
 
-        if args.prune:
-            cleaner.prune()
+        if args.prune or args.prune_all:
+            cleaner.prune(full=args.prune_all)
+        if cleaner.errors:
+            failed = True
     except RegistryCleanerError as error:
         logger.fatal(error)
         sys.exit(1)
+    finally:
+        if cleaner is not None:
+            cleaner.close()
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+    if failed:
+        sys.exit(1)
+    if cleaner.interrupted:
+        sys.exit(3)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# docker-registry-bench.py - Generate a synthetic Docker registry and benchmark docker-delete-registry-image.py
+#
+# 'generate' builds a registry v2 directory tree (repositories with tags,
+# shared layers, untagged revisions, schema1 and schema2 manifests) on local disk.
+# 'bench' times delete_repository_tag, delete_entire_repository, delete_untagged
+# and prune of one or more copies of the cleaner script on fresh copies of such
+# a tree, counts files opened and directories listed, and checks that every
+# implementation leaves the exact same tree behind.
+"""
+Usage:
+docker-registry-bench.py generate --repos 200 --tags 20 /tmp/registry
+docker-registry-bench.py bench --repos 200 --tags 20 \
+    ./docker-delete-registry-image.py /tmp/docker-delete-registry-image.orig.py
+"""
+
+import argparse
+import builtins
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+OPERATIONS = ["tag", "repository", "untagged", "prune"]
+
+
+def write_blob(root, content):
+    """store content as a blob, returning its digest"""
+    data = content.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(root, "blobs/sha256", digest[0:2], digest)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        with open(os.path.join(path, "data"), "wb") as blob:
+            blob.write(data)
+    return digest
+
+
+def write_link(path, digest):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(path, "link"), "w") as link:
+        link.write("sha256:" + digest)
+
+
+def repo_name(number):
+    """every third repository sits in a namespace, like library/nginx"""
+    if number % 3 == 0:
+        return "ns{0}/repo{1}".format(number % 7, number)
+    return "repo{0}".format(number)
+
+
+def generate(root, repos=20, tags=10, layers=8, shared_layers=20, untagged=3,
+             schema1=0.2, reuse=0.2, layer_size=1024, seed=1):
+    """build a registry v2 tree under root
+
+    Every manifest has `layers` layers, a quarter of them picked from a pool of
+    `shared_layers` layers used across all repositories. A `reuse` fraction of
+    tags point at the manifest of the previous tag, and each repository gets
+    `untagged` revisions no tag points at.
+    """
+    rnd = random.Random(seed)
+    filler = "x" * layer_size
+    pool = [write_blob(root, "shared {0} {1}".format(i, filler)) for i in range(shared_layers)]
+
+    for number in range(repos):
+        name = repo_name(number)
+        repo_dir = os.path.join(root, "repositories", name)
+        counter = [0]
+
+        def manifest():
+            counter[0] += 1
+            label = "{0} {1}".format(name, counter[0])
+            shared = rnd.sample(pool, min(len(pool), layers // 4))
+            own = [write_blob(root, "layer {0} {1} {2}".format(label, i, filler))
+                   for i in range(layers - len(shared))]
+            digests = own + shared
+            rnd.shuffle(digests)
+            if rnd.random() < schema1:
+                data = {"schemaVersion": 1, "name": name, "tag": label,
+                        "fsLayers": [{"blobSum": "sha256:" + d} for d in digests]}
+            else:
+                config = write_blob(root, json.dumps({"config": label}))
+                digests.append(config)
+                data = {"schemaVersion": 2,
+                        "config": {"digest": "sha256:" + config},
+                        "layers": [{"digest": "sha256:" + d} for d in digests[:-1]]}
+            for digest in digests:
+                write_link(os.path.join(repo_dir, "_layers/sha256", digest), digest)
+            digest = write_blob(root, json.dumps(data))
+            write_link(os.path.join(repo_dir, "_manifests/revisions/sha256", digest), digest)
+            return digest
+
+        current = None
+        for tag in range(tags):
+            if current is None or rnd.random() >= reuse:
+                current = manifest()
+            tag_dir = os.path.join(repo_dir, "_manifests/tags", "tag{0}".format(tag))
+            write_link(os.path.join(tag_dir, "current"), current)
+            write_link(os.path.join(tag_dir, "index/sha256", current), current)
+        for _ in range(untagged):
+            manifest()
+
+
+def tree_digest(root):
+    """hash of every path left under root"""
+    paths = []
+    for base, dirs, files in os.walk(root):
+        for each in dirs + files:
+            paths.append(os.path.relpath(os.path.join(base, each), root))
+    return hashlib.sha256("\n".join(sorted(paths)).encode("utf-8")).hexdigest()
+
+
+class Counters(object):
+    """count open() calls and directory listings while active"""
+
+    def __init__(self):
+        self.opened = 0
+        self.listed = 0
+
+    def __enter__(self):
+        self._open, self._listdir, self._scandir = builtins.open, os.listdir, os.scandir
+
+        def counted_open(*args, **kwargs):
+            self.opened += 1
+            return self._open(*args, **kwargs)
+
+        def counted_listdir(*args, **kwargs):
+            self.listed += 1
+            return self._listdir(*args, **kwargs)
+
+        def counted_scandir(*args, **kwargs):
+            self.listed += 1
+            return self._scandir(*args, **kwargs)
+
+        builtins.open, os.listdir, os.scandir = counted_open, counted_listdir, counted_scandir
+        return self
+
+    def __exit__(self, *exc):
+        builtins.open, os.listdir, os.scandir = self._open, self._listdir, self._scandir
+
+
+def load_cleaner(path, number):
+    """import a copy of the cleaner script as a module"""
+    spec = importlib.util.spec_from_file_location("registry_cleaner_{0}".format(number), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.logger.setLevel(logging.CRITICAL + 1)
+    return module
+
+
+def run_operation(module, root, operation, repo, tag):
+    cleaner = module.RegistryCleaner(root)
+    if operation == "tag":
+        cleaner.delete_repository_tag(repo, tag)
+    elif operation == "repository":
+        cleaner.delete_entire_repository(repo)
+    elif operation == "untagged":
+        cleaner.delete_untagged(repo)
+    elif operation == "prune":
+        cleaner.delete_repository_tag(repo, tag)
+        cleaner.prune()
+    if hasattr(cleaner, "close"):
+        cleaner.close()
+
+
+def bench(template, scripts, operations, repo, tag, repeat=1):
+    """time every operation of every script on fresh copies of template, returns result rows"""
+    modules = [load_cleaner(script, number) for number, script in enumerate(scripts)]
+    workdir = tempfile.mkdtemp(prefix="registry-bench-")
+    rows = []
+    try:
+        for operation in operations:
+            for script, module in zip(scripts, modules):
+                best = None
+                for _ in range(repeat):
+                    root = os.path.join(workdir, "v2")
+                    shutil.rmtree(root, ignore_errors=True)
+                    shutil.copytree(template, root)
+                    with Counters() as counters:
+                        start = time.perf_counter()
+                        run_operation(module, root, operation, repo, tag)
+                        seconds = time.perf_counter() - start
+                    if best is None or seconds < best["seconds"]:
+                        best = {"operation": operation, "script": script, "seconds": seconds,
+                                "opened": counters.opened, "listed": counters.listed,
+                                "result": tree_digest(root)}
+                rows.append(best)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return rows
+
+
+def add_generate_args(parser):
+    parser.add_argument("--repos", type=int, default=20, help="Number of repositories (default: 20)")
+    parser.add_argument("--tags", type=int, default=10, help="Tags per repository (default: 10)")
+    parser.add_argument("--layers", type=int, default=8, help="Layers per manifest (default: 8)")
+    parser.add_argument("--shared-layers", type=int, default=20,
+                        help="Size of the pool of layers shared across repositories (default: 20)")
+    parser.add_argument("--untagged", type=int, default=3,
+                        help="Untagged revisions per repository (default: 3)")
+    parser.add_argument("--schema1", type=float, default=0.2,
+                        help="Fraction of schema1 manifests (default: 0.2)")
+    parser.add_argument("--reuse", type=float, default=0.2,
+                        help="Fraction of tags pointing at the previous tag's manifest (default: 0.2)")
+    parser.add_argument("--layer-size", type=int, default=1024,
+                        help="Bytes of filler in every layer blob (default: 1024)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+
+
+def generate_from_args(root, args):
+    generate(root, repos=args.repos, tags=args.tags, layers=args.layers,
+             shared_layers=args.shared_layers, untagged=args.untagged, schema1=args.schema1,
+             reuse=args.reuse, layer_size=args.layer_size, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic registry generator and cleaner benchmark")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    gen = commands.add_parser("generate", help="Build a synthetic registry v2 tree")
+    add_generate_args(gen)
+    gen.add_argument("root", help="Directory to build the registry in (REGISTRY_DATA_DIR)")
+
+    run = commands.add_parser("bench", help="Benchmark cleaner scripts on a synthetic registry")
+    add_generate_args(run)
+    run.add_argument("--template", help="Use this registry tree instead of generating one")
+    run.add_argument("--operations", default=",".join(OPERATIONS),
+                     help="Comma separated operations to run (default: {0})".format(",".join(OPERATIONS)))
+    run.add_argument("--repo", default=repo_name(1), help="Repository to operate on (default: repo1)")
+    run.add_argument("--tag", default="tag1", help="Tag to delete (default: tag1)")
+    run.add_argument("--repeat", type=int, default=1, help="Runs per measurement, the fastest is kept")
+    run.add_argument("--json", dest="json_file", help="Also write the results as JSON to this file")
+    run.add_argument("scripts", nargs="*", default=["docker-delete-registry-image.py"],
+                     help="Cleaner scripts to compare (default: docker-delete-registry-image.py)")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate_from_args(args.root, args)
+        return
+
+    template = args.template
+    tmp = None
+    if template is None:
+        tmp = tempfile.mkdtemp(prefix="registry-template-")
+        template = os.path.join(tmp, "v2")
+        start = time.perf_counter()
+        generate_from_args(template, args)
+        print("Generated registry in %.2fs" % (time.perf_counter() - start), file=sys.stderr)
+    try:
+        rows = bench(template, args.scripts, args.operations.split(","), args.repo, args.tag, args.repeat)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print("%-10s %10s %8s %8s  %-12s %s" % ("operation", "seconds", "opened", "listed", "result", "script"))
+    mismatch = False
+    for row in rows:
+        first = [r for r in rows if r["operation"] == row["operation"]][0]
+        same = row["result"] == first["result"]
+        mismatch = mismatch or not same
+        print("%-10s %10.3f %8d %8d  %-12s %s%s" % (
+            row["operation"], row["seconds"], row["opened"], row["listed"],
+            row["result"][:12], row["script"], "" if same else "  <-- DIFFERENT RESULT"))
+    if args.json_file:
+        with open(args.json_file, "w") as out:
+            json.dump(rows, out, indent=2)
+    if mismatch:
+        print("Error: implementations left different registry trees behind", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()